@@ -397,6 +397,15 @@ class PlayerMatch(models.Model):
 		except PlayerMatch.DoesNotExist:
 			return None
 
+class MatchReplay(models.Model):
+	"""Compressed replay of a match, see game.replays."""
+	match = models.OneToOneField(Match, on_delete=models.CASCADE, related_name='replay')
+	data = models.BinaryField()
+	date = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return f"Replay of {self.match} ({len(self.data)} bytes)"
+
 class TournamentPlayer(models.Model):
 	tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='participants')
 	player = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='tournaments')
@@ -0,0 +1,196 @@
+import math
+
+import numpy as np
+
+
+class BatchPhysics:
+    """Struct-of-arrays physics for every active 2-player game.
+
+    Each game occupies one slot in a set of NumPy arrays and step() advances
+    all of them with vectorized operations. The rules mirror
+    GameManager.step_game_state, which remains the reference implementation;
+    scoring and status transitions are left to the manager.
+    """
+
+    FIELDS = ('p1_x', 'p1_dx', 'p2_x', 'p2_dx', 'ball_x', 'ball_y',
+              'ball_dx', 'ball_dy', 'ball_v', 'timestamp')
+
+    def __init__(self, manager, capacity=64):
+        self.manager = manager
+        self.capacity = capacity
+        self.count = 0
+        self.slots = {}
+        self.game_ids = []
+        for field in self.FIELDS:
+            setattr(self, field, np.zeros(capacity))
+        self.active = np.zeros(capacity, dtype=bool)
+        self.running = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, game_id):
+        return game_id in self.slots
+
+    def _grow(self):
+        self.capacity *= 2
+        for field in self.FIELDS + ('active', 'running'):
+            array = getattr(self, field)
+            grown = np.zeros(self.capacity, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, field, grown)
+
+    def load(self, game_id, game_state):
+        """Copy game_state into the game's slot, adding the game if needed."""
+        slot = self.slots.get(game_id)
+        if slot is None:
+            if self.count == self.capacity:
+                self._grow()
+            slot = self.count
+            self.count += 1
+            self.slots[game_id] = slot
+            self.game_ids.append(game_id)
+        ball = game_state['ball']
+        self.p1_x[slot] = game_state['player1']['x']
+        self.p1_dx[slot] = game_state['player1']['dx']
+        self.p2_x[slot] = game_state['player2']['x']
+        self.p2_dx[slot] = game_state['player2']['dx']
+        self.ball_x[slot] = ball['x']
+        self.ball_y[slot] = ball['y']
+        self.ball_dx[slot] = ball['dx']
+        self.ball_dy[slot] = ball['dy']
+        self.ball_v[slot] = ball['v']
+        self.timestamp[slot] = game_state['timestamp']
+        self.active[slot] = game_state['status'] != 'setup'
+        self.running[slot] = game_state['status'] == 'running'
+
+    def set_active(self, game_id, active):
+        slot = self.slots.get(game_id)
+        if slot is not None:
+            self.active[slot] = active
+
+    def remove(self, game_id):
+        slot = self.slots.pop(game_id, None)
+        if slot is None:
+            return
+        last = self.count - 1
+        if slot != last:
+            # Move the last game into the freed slot to keep arrays dense.
+            for field in self.FIELDS + ('active', 'running'):
+                array = getattr(self, field)
+                array[slot] = array[last]
+            moved = self.game_ids[last]
+            self.game_ids[slot] = moved
+            self.slots[moved] = slot
+        self.game_ids.pop()
+        self.count = last
+
+    def step(self, timestamp):
+        """Advance all games to timestamp.
+
+        Returns a list of (game_id, scorer) tuples for goals scored during
+        this step, scorer being 'p1' or 'p2'.
+        """
+        n = self.count
+        if not n:
+            return []
+        m = self.manager
+        height, width = m.arena_height, m.arena_width
+        paddle_len = m.paddle_len
+
+        active = self.active[:n]
+        running = self.running[:n]
+        p1_x, p2_x = self.p1_x[:n], self.p2_x[:n]
+        ball_x, ball_y = self.ball_x[:n], self.ball_y[:n]
+        ball_dx, ball_dy = self.ball_dx[:n], self.ball_dy[:n]
+        ball_v = self.ball_v[:n]
+
+        timedelta = np.where(active, timestamp - self.timestamp[:n], 0)
+        timedelta *= m.speed_scale
+        self.timestamp[:n][active] = timestamp
+
+        p1_x += self.p1_dx[:n] * m.paddle_speed * timedelta
+        p2_x += self.p2_dx[:n] * m.paddle_speed * timedelta
+        np.clip(p1_x, -height + paddle_len, height - paddle_len, out=p1_x)
+        np.clip(p2_x, -height + paddle_len, height - paddle_len, out=p2_x)
+
+        start_x, start_y = ball_x.copy(), ball_y.copy()
+        ball_x += ball_dx * ball_v * timedelta
+        ball_y += ball_dy * ball_v * timedelta
+
+        # Wall collisions
+        wall = running & ((ball_x <= -height + m.ball_size)
+                          | (ball_x >= height - m.ball_size))
+        ball_dx[wall] *= -1.1
+        ball_x[running] = np.clip(ball_x[running], -height, height)
+
+        # Paddle collisions, swept from the position before the move (see
+        # GameManager.paddle_collision)
+        for paddle_x, line, side in ((p1_x, -width + m.goal_line, 1),
+                                     (p2_x, width - m.goal_line, -1)):
+            reached = (running & (ball_dy * side < 0)
+                       & ((ball_y - line) * side <= 0))
+            if not reached.any():
+                continue
+            before = reached & ((start_y - line) * side > 0)
+            t = np.zeros(n)
+            t[before] = ((start_y[before] - line)
+                         / (start_y[before] - ball_y[before]))
+            x = start_x + (ball_x - start_x) * t
+            hit = (reached & (paddle_x - paddle_len <= x)
+                   & (x <= paddle_x + paddle_len))
+            if not hit.any():
+                continue
+            y = start_y[hit] + (ball_y[hit] - start_y[hit]) * t[hit]
+            ref_angle = (x[hit] - paddle_x[hit]) / paddle_len * (math.pi / 4)
+            dy = side * np.cos(ref_angle)
+            dx = np.sin(ref_angle)
+            magnitude = np.sqrt(dx**2 + dy**2)
+            ball_dx[hit] = dx / magnitude
+            ball_dy[hit] = dy / magnitude
+            ball_v[hit] = np.minimum(ball_v[hit] + 0.1, m.max_speed)
+            rest = ball_v[hit] * timedelta[hit] * (1 - t[hit])
+            ball_x[hit] = np.clip(x[hit] + ball_dx[hit] * rest, -height, height)
+            ball_y[hit] = y + ball_dy[hit] * rest
+
+        # Goals
+        goals = []
+        for scorer, goal in (('p1', running & (ball_y >= width + m.ball_size)),
+                             ('p2', running & (ball_y <= -width - m.ball_size))):
+            for slot in np.flatnonzero(goal):
+                goals.append((self.game_ids[slot], scorer))
+        return goals
+
+    def write_back(self, games, game_ids=None):
+        """Copy the physics fields of the given games (default: all) into
+        their state dicts."""
+        if game_ids is None:
+            game_ids = self.game_ids[:]
+        game_ids = [game_id for game_id in game_ids
+                    if game_id in self.slots and game_id in games]
+        if not game_ids:
+            return
+        slots = [self.slots[game_id] for game_id in game_ids]
+        columns = [getattr(self, field)[slots].tolist() for field in self.FIELDS]
+        for game_id, (p1_x, _, p2_x, _, ball_x, ball_y, ball_dx, ball_dy,
+                      ball_v, timestamp) in zip(game_ids, zip(*columns)):
+            game_state = games[game_id]
+            ball = game_state['ball']
+            game_state['player1']['x'] = p1_x
+            game_state['player2']['x'] = p2_x
+            ball['x'] = ball_x
+            ball['y'] = ball_y
+            ball['dx'] = ball_dx
+            ball['dy'] = ball_dy
+            ball['v'] = ball_v
+            game_state['timestamp'] = timestamp
+
+    def set_direction(self, game_id, player, direction):
+        """Set a paddle's dx, leaving the rest of the game as it is."""
+        slot = self.slots.get(game_id)
+        if slot is not None:
+            dx = self.p1_dx if player == 'player1' else self.p2_dx
+            dx[slot] = direction
+
+    def timestamp_of(self, game_id):
+        return float(self.timestamp[self.slots[game_id]])
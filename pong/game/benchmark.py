@@ -0,0 +1,378 @@
+"""Headless throughput benchmark for the game engines.
+
+Runs N simulated matches with scripted paddle inputs, without Django or a
+Redis server, and reports tick throughput and latency:
+
+    cd pong && python -m game.benchmark --games 200 --ticks 640 \\
+        --output bench.json --compare previous-bench.json
+
+Engines:
+    scalar  GameManager in-memory engine, per-game scalar physics
+    numpy   GameManager in-memory engine, BatchPhysics
+    4p      4-player rooms (four_player_room.Room), simulation and frames
+
+Every tick advances a simulated clock by 1 / rate so matches play out at
+real game speed however fast the host is. Only the tick itself is timed;
+scripted inputs are applied between ticks. max_games is the number of
+concurrent games one core could tick at the given rate, extrapolated
+linearly from the p99 tick latency. Allocations are measured in a separate,
+shorter pass under tracemalloc (which slows the tick down): alloc_blocks is
+the number of memory blocks still allocated after a tick that were
+allocated during it, alloc_peak_bytes the transient peak above the memory
+in use before the tick.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+from .four_player_room import Room
+from .game_manager import GameManager
+
+ENGINES = ('scalar', 'numpy', '4p')
+
+
+class InMemoryRedis:
+    """The subset of the redis.asyncio client used by the in-memory engine."""
+
+    def __init__(self):
+        self.data = {}
+        # published frames are only counted, nobody subscribes
+        self.published = 0
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    async def publish(self, channel, message):
+        self.published += 1
+        return 0
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def hset(self, key, field=None, value=None, mapping=None):
+        entry = self.data.setdefault(key, {})
+        if field is not None:
+            entry[field] = value
+        entry.update(mapping or {})
+
+    async def expire(self, key, seconds):
+        return key in self.data
+
+    async def zadd(self, key, mapping, nx=False):
+        scores = self.data.setdefault(key, {})
+        for member, score in mapping.items():
+            if not (nx and member in scores):
+                scores[member] = score
+
+    async def zrem(self, key, *members):
+        scores = self.data.get(key, {})
+        return sum(scores.pop(member, None) is not None for member in members)
+
+    def pipeline(self, transaction=True):
+        return InMemoryPipeline(self)
+
+
+class InMemoryPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class SimulatedClock:
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class HeadlessGameManager(GameManager):
+    """GameManager ticked by the benchmark instead of its scheduler task."""
+
+    def start_game_update_task(self, game_id):
+        self.active_games.add(game_id)
+        self.wake_game(game_id)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def aim_error(errors, key, tick, rate, spread, rng):
+    """Imperfect players: each one misjudges the ball by an offset that
+    changes about once a second, so some balls are missed."""
+    error = errors.get(key)
+    if error is None or tick >= error[1]:
+        error = (rng.gauss(0, spread), tick + rng.randint(rate // 2, rate * 2))
+        errors[key] = error
+    return error[0]
+
+
+def follow(target, position, deadband):
+    if target > position + deadband:
+        return 1
+    if target < position - deadband:
+        return -1
+    return 0
+
+
+class TwoPlayerMatches:
+    """N concurrent 2-player games with paddles tracking the ball."""
+
+    def __init__(self, games, rate, send_rate, physics, rng):
+        self.clock = SimulatedClock()
+        self.manager = HeadlessGameManager(
+            physics=physics, sharded=False, clock=self.clock,
+            tick_rate=rate, send_rate=send_rate)
+        self.manager.client = InMemoryRedis()
+        self.rate = rate
+        self.rng = rng
+        self.game_ids = [f'bench-{index}' for index in range(games)]
+        self.directions = {}
+        self.aim = {}
+        self.paused_since = {}
+        self.goals = 0
+        self.finished = 0
+
+    async def setup(self):
+        for game_id in self.game_ids:
+            await self.start(game_id)
+
+    async def start(self, game_id):
+        await self.manager.reset_game_state(game_id)
+        self.directions[game_id] = {'player1': 0, 'player2': 0}
+        for player in ('player1', 'player2'):
+            await self.manager.set_player_ready(game_id, player)
+
+    async def play(self, tick):
+        manager = self.manager
+        for game_id in self.game_ids:
+            game_state = manager.games[game_id]
+            status = game_state['status']
+            if status in ('finished', 'forfeited'):
+                self.finished += 1
+                self.goals += game_state['score']['p1'] + game_state['score']['p2']
+                await self.start(game_id)
+                continue
+            if status != 'running':
+                # players take a moment to press ready after a goal
+                since = self.paused_since.setdefault(game_id, tick)
+                if tick - since >= self.rate // 2:
+                    del self.paused_since[game_id]
+                    for player in ('player1', 'player2'):
+                        await manager.set_player_ready(game_id, player)
+                continue
+            directions = self.directions[game_id]
+            for player in ('player1', 'player2'):
+                direction = follow(game_state['ball']['x'] + self.aim_error(game_id, player, tick),
+                                   game_state[player]['x'], manager.paddle_speed)
+                if direction != directions[player]:
+                    directions[player] = direction
+                    await manager.update_player_state(game_id, player, direction)
+
+    def aim_error(self, game_id, player, tick):
+        return aim_error(self.aim, (game_id, player), tick, self.rate,
+                         self.manager.paddle_len * 2, self.rng)
+
+    async def tick(self):
+        self.clock.advance(1 / self.rate)
+        await self.manager.tick_all()
+        # what run_scheduler does after each tick
+        self.manager.tick_count += 1
+
+    def stats(self):
+        scores = [game_state['score'] for game_state in self.manager.games.values()]
+        return {'goals': self.goals + sum(score['p1'] + score['p2'] for score in scores),
+                'finished_games': self.finished,
+                'frames_sent': self.manager.client.published}
+
+
+class FourPlayerMatches:
+    """N concurrent 4-player rooms, each paddle tracking the ball."""
+
+    def __init__(self, games, rate, rng):
+        self.rate = rate
+        self.rng = rng
+        self.rooms = [Room(f"bench{index}", publish=None) for index in range(games)]
+        self.aim = {}
+        self.goals = 0
+        self.frames = 0
+        self.frame_bytes = 0
+
+    async def setup(self):
+        for room in self.rooms:
+            room.initialize()
+
+    async def play(self, tick):
+        for index, room in enumerate(self.rooms):
+            field, ball = room.data.field, room.data.ball
+            for paddle in field.paddles:
+                error = aim_error(self.aim, (index, paddle.side), tick, self.rate,
+                                  field.paddle_len, self.rng)
+                if paddle.vertical:
+                    paddle.dir = follow(ball.pos_y + error, paddle.y, field.paddle_speed)
+                else:
+                    paddle.dir = follow(ball.pos_x + error, paddle.x, field.paddle_speed)
+
+    async def tick(self):
+        # what Room.run does on each deadline, without publishing
+        for room in self.rooms:
+            frame = room.tick()
+            if frame is not None:
+                self.frames += 1
+                self.frame_bytes += len(frame)
+                if room.paused:
+                    self.goals += 1
+
+    def stats(self):
+        return {'goals': self.goals, 'frames_sent': self.frames,
+                'frame_bytes': self.frame_bytes}
+
+
+def make_matches(engine, games, rate, send_rate, seed):
+    rng = random.Random(seed)
+    random.seed(seed)
+    if engine == '4p':
+        return FourPlayerMatches(games, rate, rng)
+    return TwoPlayerMatches(games, rate, send_rate, engine, rng)
+
+
+async def run_engine(engine, games, ticks, rate, send_rate, seed, alloc_ticks):
+    matches = make_matches(engine, games, rate, send_rate, seed)
+    await matches.setup()
+    durations = []
+    for tick in range(ticks):
+        await matches.play(tick)
+        started = time.perf_counter()
+        await matches.tick()
+        durations.append(time.perf_counter() - started)
+
+    blocks, peaks = [], []
+    tracemalloc.start()
+    for tick in range(ticks, ticks + alloc_ticks):
+        await matches.play(tick)
+        before = tracemalloc.take_snapshot()
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        await matches.tick()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        blocks.append(sum(stat.count_diff for stat in after.compare_to(before, 'traceback')
+                          if stat.count_diff > 0))
+        peaks.append(peak - used)
+    tracemalloc.stop()
+
+    total = sum(durations)
+    durations.sort()
+    p99 = percentile(durations, 0.99)
+    return {
+        'games': games,
+        'ticks': ticks,
+        'ticks_per_sec': ticks / total,
+        'game_ticks_per_sec': games * ticks / total,
+        'tick_p50_ms': percentile(durations, 0.50) * 1000,
+        'tick_p99_ms': p99 * 1000,
+        'tick_max_ms': durations[-1] * 1000,
+        'max_games': int(games / (p99 * rate)),
+        'alloc_blocks_per_tick': sum(blocks) / len(blocks) if blocks else None,
+        'alloc_peak_bytes_per_tick': sum(peaks) / len(peaks) if peaks else None,
+        **matches.stats(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    for engine, result in results['engines'].items():
+        previous = baseline.get('engines', {}).get(engine)
+        if previous is None:
+            continue
+        for key in ('game_ticks_per_sec', 'tick_p99_ms', 'max_games'):
+            change = (result[key] - previous[key]) / previous[key] * 100
+            print(f"{engine:>6} {key:<20} {previous[key]:>12.2f} -> "
+                  f"{result[key]:>12.2f} ({change:+.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--ticks', type=int, default=640)
+    parser.add_argument('--rate', type=int, default=60,
+                        help='simulated tick rate in Hz')
+    parser.add_argument('--send-rate', type=int, default=20,
+                        help='frames sent per second and game')
+    parser.add_argument('--alloc-ticks', type=int, default=32,
+                        help='ticks measured under tracemalloc')
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args(argv)
+
+    results = {
+        'commit': git_commit(),
+        'created': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'config': {'games': args.games, 'ticks': args.ticks, 'rate': args.rate,
+                   'send_rate': args.send_rate, 'seed': args.seed},
+        'engines': {},
+    }
+    for engine in args.engines.split(','):
+        if engine not in ENGINES:
+            parser.error(f"unknown engine {engine}")
+        result = asyncio.run(run_engine(engine, args.games, args.ticks, args.rate,
+                                        args.send_rate, args.seed, args.alloc_ticks))
+        results['engines'][engine] = result
+        print(f"{engine:>6}: {result['game_ticks_per_sec']:>10.0f} game ticks/s, "
+              f"p50 {result['tick_p50_ms']:.3f} ms, p99 {result['tick_p99_ms']:.3f} ms, "
+              f"{result['alloc_blocks_per_tick']:.0f} blocks/tick, "
+              f"max {result['max_games']} games at {args.rate} Hz")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+    return results
+
+
+if __name__ == '__main__':
+    main()
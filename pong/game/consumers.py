@@ -1,6 +1,8 @@
 import json
 import asyncio
+import zlib
 import jwt
+from urllib.parse import parse_qs
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -8,8 +10,10 @@ from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from api.models import Match, Profile, PlayerMatch, Tournament, TournamentPlayer
-from .game_manager import game_manager
+from api.models import Match, MatchReplay, Profile, PlayerMatch, Tournament, TournamentPlayer
+from .game_feed import FrameOutbox
+from .game_manager import game_manager, GameManager
+from .replays import ReplayPlayer
 
 from blockchain.blockchain_api import PongBlockchain, hash_player
 import os
@@ -35,6 +39,26 @@ def get_match(match_id):
 def update_player_match(match, player, score, win=False):
 	PlayerMatch.objects.filter(match=match, player=player).update(score=score,winner=win)
 
+@database_sync_to_async
+def save_replay(match, data):
+	MatchReplay.objects.update_or_create(match=match, defaults={'data': data})
+
+@database_sync_to_async
+def get_replay(match_id):
+	return bytes(MatchReplay.objects.get(match_id=match_id).data)
+
+async def get_token_user(scope):
+	"""Return the user of the token query parameter, or None."""
+	token = parse_qs(scope['query_string'].decode()).get('token', [''])[0]
+	try:
+		decoded_token = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+		return await get_user_by_id(decoded_token['user_id'])
+	except (jwt.InvalidTokenError, KeyError, get_user_model().DoesNotExist):
+		return None
+
+# Physics for replays, separate from the live engine's game state.
+replay_engine = GameManager(sharded=False, publish=False)
+
 class PongGameConsumer(AsyncWebsocketConsumer):
 
 	def __init__(self, *args, **kwargs):
@@ -46,7 +70,6 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 		self.gameover = False
 		self.score_limit = 1
 		self.game_id = None
-		self.update_interval = 1 / 32
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.players = {}
@@ -56,12 +79,20 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 		self.gameover = False
 		self.score_limit = 11
 		self.game_id = None
-		self.update_interval = 1 / 32
+		self.binary_frames = False
+		self.spectating = False
+		self.outbox = FrameOutbox(self.send)
+		self.last_status = None
 
 	async def connect(self):
 		self.challenger = self.scope["url_route"]["kwargs"]["challenger"]
 		self.match_group_name = f"match_{self.challenger}"
-		self.token = self.scope['query_string'].decode().split('=')[1]
+		# spectators leave the players' group for their own
+		self.spectator_group_name = f"spectate_{self.challenger}"
+		query = parse_qs(self.scope['query_string'].decode())
+		self.token = query.get('token', [''])[0]
+		# clients may opt in to binary game_state frames (see state_codec)
+		self.binary_frames = query.get('encoding', [''])[0] == 'binary'
 		try:
 			decoded_token = jwt.decode(
 				self.token, settings.SECRET_KEY, algorithms=["HS256"])
@@ -98,17 +129,16 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 			"message": f"Joined channel: {self.challenger}",
 		}))
 
-
-		self.game_task = asyncio.create_task(self.game_update_loop())
-
 	def cancel_tasks(self):
-		if hasattr(self, "game_task"):
-			self.game_task.cancel()
 		if hasattr(self, "timeout_task"):
 			self.timeout_task.cancel()
 
 	async def disconnect(self, close_code):
 		self.cancel_tasks()
+		if self.game_id:
+			await game_manager.feed.unsubscribe(
+				self.game_id, self.game_frame, spectator=self.spectating)
+		self.outbox.close()
 		if self.channel_name in self.connection_player_map:
 			disconnected_player = self.connection_player_map.pop(
 				self.channel_name)
@@ -116,9 +146,10 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 				await game_manager.forfeit_game(self.game_id, disconnected_player)
 				await self.handle_forfeit(disconnected_player)
 			if self.gameover:
-				await sync_to_async(game_manager.clear_game_state)(self.game_id)
+				await game_manager.clear_game_state(self.game_id)
 		elif self.channel_name in self.spectators:
 			self.spectators.remove(self.channel_name)
+			await game_manager.live.add_viewer(self.game_id, -1)
 		
 
 		# avoid dueling while in game
@@ -127,7 +158,7 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 		await sync_to_async(profile.save)()
 
 		await self.channel_layer.group_discard(
-			self.match_group_name,
+			self.spectator_group_name if self.spectating else self.match_group_name,
 			self.channel_name
 		)
 
@@ -160,7 +191,9 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 			}))
 
 			self.game_id = f"{self.match_group_name}@{match_id}"
-			game_manager.reset_game_state(self.game_id, self.score_limit)
+			await game_manager.feed.subscribe(self.game_id, self.game_frame)
+			await game_manager.reset_game_state(self.game_id, self.score_limit)
+			await game_manager.live.add_player(self.game_id, player, player_username)
 			self.timeout_task = asyncio.create_task(self.countdown_to_start())
 			return
 
@@ -187,9 +220,9 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 		if self.channel_name in self.connection_player_map:
 			del self.connection_player_map[self.channel_name]
 
-	async def receive(self, text_data):
+	async def receive(self, text_data=None, bytes_data=None):
 		logger.debug(f"{text_data}")
-		if self.gameover:
+		if self.gameover or text_data is None:
 			return
 		try:
 			data = json.loads(text_data)
@@ -202,12 +235,15 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 
 		if msg_type in ["player1_move", "player2_move"]:
 			direction = data.get("direction")
-			if direction is None:
+			# optional input sequence number, acknowledged in the frames
+			seq = data.get("seq")
+			if not game_manager.is_direction(direction) or (
+					seq is not None and not (isinstance(seq, int) and 0 < seq < 2**32)):
 				logger.debug(f"Invalid data for {msg_type}: {data}")
 			elif msg_type == "player1_move" and player == "player1":
-				await self.update_player_state("player1", direction)
+				await self.update_player_state("player1", direction, seq)
 			elif msg_type == "player2_move" and player == "player2":
-				await self.update_player_state("player2", direction)
+				await self.update_player_state("player2", direction, seq)
 			return
 
 		match msg_type:
@@ -217,13 +253,8 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 			case "register":
 				await self.register_player(data)
 			case "spectate":
-				if data.has_key("match_id"):
-					self.game_id = f"{self.match_group_name}@{data['match_id']}"
-					self.spectators.add(self.channel_name)
-					await self.send(text_data=json.dumps({
-						"type": "spectate",
-						"message": "You are now spectating the match"
-					}))
+				if "match_id" in data and not self.game_id:
+					await self.spectate(data["match_id"])
 			case "accept" | "decline":
 				await self.channel_layer.group_send(
 					self.match_group_name,
@@ -241,6 +272,27 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 					}
 				)
 
+	async def spectate(self, match_id):
+		self.game_id = f"{self.match_group_name}@{match_id}"
+		self.spectating = True
+		self.spectators.add(self.channel_name)
+		await self.channel_layer.group_discard(
+			self.match_group_name,
+			self.channel_name
+		)
+		await self.channel_layer.group_add(
+			self.spectator_group_name,
+			self.channel_name
+		)
+		# the slower spectator stream, see GameManager.publish_frames
+		await game_manager.feed.subscribe(
+			self.game_id, self.game_frame, spectator=True)
+		await game_manager.live.add_viewer(self.game_id)
+		await self.send(text_data=json.dumps({
+			"type": "spectate",
+			"message": "You are now spectating the match"
+		}))
+
 	async def accept_msg(self, event):
 		if self.game_id:
 			return
@@ -272,38 +324,11 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 	async def countdown_to_start(self):
 		await asyncio.sleep(30)
 		if not self.gameover:
-			game_state = game_manager.get_game_state(self.game_id)
+			game_state = await game_manager.get_game_state(self.game_id)
 			if not game_state or game_state["status"] == "starting":
 				winner = self.connection_player_map.get(self.channel_name)
 				await self.win_by_timeout(winner)
 
-	async def game_update_loop(self):
-		while True:
-			try:
-				if not self.game_id:
-					await asyncio.sleep(1)
-					continue
-				game_state = game_manager.get_game_state(self.game_id)
-				if not game_state:
-					await asyncio.sleep(1)
-					continue
-
-				if game_state["status"] == "finished":
-					await self.send_game_state()
-					self.gameover = True
-					await self.save_match_results(game_state)
-					break
-				elif game_state["status"] == "forfeited":
-					await self.send_game_state()
-					self.gameover = True
-					await self.handle_forfeit(game_state["forfeiting_player"])
-					break
-
-				await self.send_game_state()
-				await asyncio.sleep(self.update_interval)
-			except Exception as e:
-				logger.error(f"Error in game update loop: {e}")
-
 	async def save_match_results(self, game_state):
 		try:
 			p1_score, p2_score = game_state["score"]["p1"], game_state["score"]["p2"]
@@ -320,16 +345,20 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 
 		except Exception as e:
 			logger.error(f"Error saving match results: {e}")
+		await self.save_replay()
 		self.cancel_tasks()
 
 	async def win_by_timeout(self, winner):
+		# set first: the forfeited frame must not start another handle_forfeit
+		self.gameover = True
 		try:
 			loser = "player1" if winner == "player2" else "player2"
+			# ends the game in the engine, which stores its replay at once
+			await game_manager.forfeit_game(self.game_id, loser)
 			await self.handle_forfeit(loser)
 		except Exception as e:
 			logger.error(f"Error handling win by timeout: {e}")
 
-		self.gameover = True
 		self.cancel_tasks()
 
 	async def handle_forfeit(self, forfeiting_player):
@@ -348,27 +377,45 @@ class PongGameConsumer(AsyncWebsocketConsumer):
 
 		except Exception as e:
 			logger.error(f"Error handling forfeit: {e}")
+		await self.save_replay()
 		self.cancel_tasks()
 
-	async def send_game_state(self):
-		game_state = game_manager.get_game_state(self.game_id)
-		await self.channel_layer.group_send(
-			self.match_group_name,
-			{
-				"type": "game_state",
-				"game_state": game_state
-			}
-		)
-
-	async def game_state(self, event):
-		game_state = event["game_state"]
-		await self.send(text_data=json.dumps({
-			"type": "game_state",
-			"game_state": game_state
-		}))
+	async def save_replay(self):
+		# The worker stores the replay with the final frame, which may reach
+		# us first (the Redis scripts publish it, forfeits are ticked later).
+		try:
+			data = await game_manager.wait_for_replay(self.game_id)
+			if data is None:
+				logger.warning(f"No replay recorded for {self.game_id}")
+				return
+			await save_replay(self.match, data)
+		except Exception as e:
+			logger.error(f"Error saving replay: {e}")
+
+	async def game_frame(self, frame):
+		# published once per tick and on status changes by the worker
+		# running the game, delivered through game_manager.feed
+		game_state = frame.state
+		# a frame not sent yet is replaced by the next one, unless the
+		# status changed with it
+		droppable = game_state["status"] == self.last_status
+		self.last_status = game_state["status"]
+		if self.binary_frames:
+			self.outbox.put(droppable, bytes_data=frame.data)
+		else:
+			self.outbox.put(droppable, text_data=frame.text)
+		if self.gameover or self.spectating:
+			return
+		if game_state["status"] == "finished":
+			self.gameover = True
+			self.end_task = asyncio.create_task(self.save_match_results(game_state))
+		elif game_state["status"] == "forfeited":
+			self.gameover = True
+			self.end_task = asyncio.create_task(
+				self.handle_forfeit(game_state["forfeiting_player"]))
 
-	async def update_player_state(self, player, direction):
-		await game_manager.update_player_state(self.game_id, player, direction)
+	async def update_player_state(self, player, direction, seq=None):
+		await game_manager.update_player_state(self.game_id, player, direction, seq)
 
 	async def set_player_ready(self, player):
 		await game_manager.set_player_ready(self.game_id, player)
@@ -491,339 +538,136 @@ class PongTournamentConsumer(AsyncWebsocketConsumer):
 			"message": message
 		}))
 
+class LiveGamesConsumer(AsyncWebsocketConsumer):
+	"""Directory of live games: a first page of games on connect, then every
+	change published by the engine (see LiveGames)."""
+
+	async def connect(self):
+		self.user = await get_token_user(self.scope)
+		if not self.user:
+			await self.close()
+			return
+
+		self.outbox = FrameOutbox(self.send)
+		await self.accept()
+		live = game_manager.live
+		# subscribe first so no change is missed while the page is read
+		await game_manager.feed.subscribe_channel(live.changes_channel, self.live_change)
+		games, count = await live.list(limit=settings.REST_FRAMEWORK['PAGE_SIZE'])
+		await self.send(text_data=json.dumps({
+			"type": "live_games",
+			"count": count,
+			"games": games,
+		}))
+
+	async def disconnect(self, close_code):
+		if hasattr(self, "outbox"):
+			await game_manager.feed.unsubscribe_channel(
+				game_manager.live.changes_channel, self.live_change)
+			self.outbox.close()
+
+	async def live_change(self, frame):
+		# changes are partial, none of them can be dropped
+		self.outbox.put(False, text_data=frame.text)
+
+class ReplayConsumer(AsyncWebsocketConsumer):
+	"""Plays back the replay of a match as game_state messages, at 1x, 2x
+	or 4x speed (speed query parameter or speed message)."""
+	speeds = (1, 2, 4)
+
+	async def connect(self):
+		self.match_id = self.scope["url_route"]["kwargs"]["match_id"]
+		self.user = await get_token_user(self.scope)
+		if not self.user:
+			await self.close()
+			return
+		query = parse_qs(self.scope['query_string'].decode())
+		speed = query.get('speed', ['1'])[0]
+		self.speed = int(speed) if speed in ('1', '2', '4') else 1
+		try:
+			self.player = ReplayPlayer(await get_replay(self.match_id), replay_engine)
+		except (MatchReplay.DoesNotExist, ValueError, zlib.error) as e:
+			logger.info(f"No replay for match {self.match_id}: {e}")
+			await self.close()
+			return
+		await self.accept()
+		self.play_task = asyncio.create_task(self.play())
+
+	async def play(self):
+		# each frame covers speed frames of game time, sent at the send rate
+		loop = asyncio.get_running_loop()
+		interval = 1 / replay_engine.send_rate
+		deadline = loop.time()
+		while not self.player.done:
+			game_state = self.player.advance(self.speed * interval)
+			if game_state is not None:
+				await self.send(text_data=json.dumps({
+					"type": "game_state",
+					"game_state": game_state,
+				}))
+			deadline += interval
+			await asyncio.sleep(max(0, deadline - loop.time()))
+		await self.send(text_data=json.dumps({"type": "replay_end"}))
+
+	async def receive(self, text_data=None, bytes_data=None):
+		try:
+			data = json.loads(text_data)
+		except Exception as e:
+			logger.error(f"Error in consumer receive: {e}\nData: {text_data}")
+			return
+		if data.get("type") == "speed" and data.get("speed") in self.speeds:
+			self.speed = data["speed"]
+
+	async def disconnect(self, close_code):
+		if hasattr(self, "play_task"):
+			self.play_task.cancel()
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from asgiref.sync import async_to_sync
 import json
-import random
-import math
 import asyncio
-import time
-import copy
-
-BALL_SIZE = 4
-BALL_START_SPEED = 2 / 12
-BALL_INCR_SPEED = 1 / 64
-GOAL_LINE = 10
-PADDLE_SPEED = 5
-PADDLE_LEN = 42
-PADDLE_WIDTH = 6
-
-class Ball:
-	def __init__(self):
-		async_to_sync(self.initialize())
-		self.radius = BALL_SIZE / 2 / 200 * 100
-		self.incr_speed = BALL_INCR_SPEED / 200 * 100
-		self.initialize()
-
-	def initialize(self):
-		self.pos_x = 50
-		self.pos_y = 50
-		rand = random.random()
-		if rand < 0.25:
-			self.vx = 1
-			self.vy = 1
-		elif rand < 0.5:
-			self.vx = 1
-			self.vy = -1
-		elif rand < 0.75:
-			self.vx = -1
-			self.vy = 1
-		else:
-			self.vx = -1
-			self.vy = -1
 
-		rand = random.random()
-		if rand <= 0.5:
-			self.speedx = BALL_START_SPEED / 300 * 70
-			self.speedy = BALL_START_SPEED / 200 * 70
-		else:
-			self.speedx = BALL_START_SPEED / 200 * 70
-			self.speedy = BALL_START_SPEED / 300 * 70
-
-	async def speed_up (self):
-		self.speedx += self.incr_speed
-		self.speedy += self.incr_speed
-
-	async def move(self):
-		self.pos_x += self.vx * self.speedx * 1000 / 60
-		self.pos_y += self.vy * self.speedy * 1000 / 60
-
-class Field:
-
-	def __init__(self):
-		self.initialize()
-
-	def initialize(self):
-		self.paddle_width = PADDLE_WIDTH / 300 * 100
-		self.paddle_len = PADDLE_LEN / 200 * 100
-		self.paddle_speed = PADDLE_SPEED / 200 * 100
-		self.goal_line = GOAL_LINE / 200 * 100
-		self.limit_min = self.paddle_len / 2
-		self.limit_max = 100 - self.paddle_len / 2
-
-		self.paddle = {"left": {"dir": 0, "x": self.goal_line + self.paddle_width / 2, "y": 50},
-			"right": {"dir": 0, "x": 100 - self.goal_line - self.paddle_width / 2, "y": 50},
-			"top": {"dir": 0, "x": 50, "y": self.goal_line + self.paddle_width / 2},
-			"bottom": {"dir": 0, "x": 50, "y": 100 - self.goal_line - self.paddle_width / 2}}
-	
-	async def	move(self):
-		for key in self.paddle:
-			if(self.paddle[key]["dir"] == 0):
-				continue
-			if(key == "left" or key == "right"):
-				self.paddle[key]["y"] += self.paddle_speed * self.paddle[key]["dir"]
-				if(self.paddle[key]["y"] < self.limit_min):
-					self.paddle[key]["y"] = self.limit_min
-				elif(self.paddle[key]["y"] > self.limit_max):
-					self.paddle[key]["y"] = self.limit_max
-			elif (key == "top" or key == "bottom"):
-				self.paddle[key]["x"] += self.paddle_speed * self.paddle[key]["dir"]
-				if(self.paddle[key]["x"] < self.limit_min):
-					self.paddle[key]["x"] = self.limit_min
-				elif(self.paddle[key]["x"] > self.limit_max):
-					self.paddle[key]["x"] = self.limit_max
-
-class Score:
-	def __init__(self):
-		self.initialize()
-
-	def initialize(self):
-		self.left = 0
-		self.right = 0
-		self.top = 0
-		self.bottom = 0
-		self.conceded = ""
-		self.last_touch = "none"
-
-	async def update_score(self):
-		if self.last_touch == "left":
-			self.left += 1
-		elif self.last_touch == "right":
-			self.right += 1
-		elif self.last_touch == "top":
-			self.top += 1
-		elif self.last_touch == "bottom":
-			self.bottom += 1
-
-		if self.conceded.find("left") != -1:
-			self.left -= 1
-		elif self.conceded.find("right") != -1:
-			self.right -= 1
-		elif self.conceded.find("top") != -1:
-			self.top -= 1
-		elif self.conceded.find("bottom") != -1:
-			self.bottom -= 1
-
-class Data:
-	def __init__(self):
-		self.ball = Ball()
-		self.field = Field()
-		self.score = Score()
-		self.old_score = Score()
-		self.goal = False
-		self.animation_time = {"first": 0, "second": 0, "third": 0} # {first: 500, second: 1000, third: 1500};
-
-	def initialize(self):
-		self.ball.initialize()
-		self.field.initialize()
-		self.score.initialize()
-		self.old_score.initialize()
-		self.goal = False
-		self.animation_time = {"first": 0, "second": 0, "third": 0} # {first: 500, second: 1000, third: 1500};
-
-	async def check_goal(self):
-		self.score.conceded = ""
-		self.goal = False
-
-		if self.ball.pos_x < 0:
-			self.goal = True
-			self.score.conceded += "left"
-		elif self.ball.pos_x > 100:
-			self.goal = True
-			self.score.conceded += "right"
-
-		if self.ball.pos_y < 0:
-			self.goal = True
-			self.score.conceded += "top"
-		elif self.ball.pos_y > 100:
-			self.goal = True
-			self.score.conceded += "bottom"
-
-		if self.goal == True:
-			current_time = time.time()
-			self.animation_time["first"] = 0.5 + current_time
-			self.animation_time["second"] = 1 + current_time
-			self.animation_time["third"] = 1.5 + current_time
-
-	async def check_collisions(self):
-		
-		paddleWidth = self.field.paddle_width
-		paddleLen = self.field.paddle_len
-
-		if self.ball.pos_x - self.ball.radius <= self.field.paddle["left"]["x"] + paddleWidth / 2:
-			if not (self.score.last_touch == "left" or self.ball.pos_x - self.ball.radius < self.field.paddle["left"]["x"] - paddleWidth):
-				if self.ball.pos_y + self.ball.radius >= self.field.paddle["left"]["y"] - paddleLen / 2 and \
-					self.ball.pos_y - self.ball.radius <= self.field.paddle["left"]["y"] + paddleLen / 2:
-
-					ref_angle = (self.ball.pos_y - self.field.paddle["left"]["y"]) / (paddleLen / 2) * (math.pi / 4)
-					self.ball.vx = 1 * math.cos(ref_angle)
-					self.ball.vy = math.sin(ref_angle)
-					self.ball.speed_up()
-					self.score.last_touch = "left"
-
-		elif self.ball.pos_x + self.ball.radius >= self.field.paddle["right"]["x"] - paddleWidth / 2:
-			if not (self.score.last_touch == "right" or self.ball.pos_x + self.ball.radius > self.field.paddle["right"]["x"] + paddleWidth):
-				if self.ball.pos_y + self.ball.radius >= self.field.paddle["right"]["y"] - paddleLen/ 2 and \
-					self.ball.pos_y - self.ball.radius <= self.field.paddle["right"]["y"] + paddleLen/ 2:
-					
-					ref_angle = (self.ball.pos_y - self.field.paddle["right"]["y"]) / (paddleLen/ 2) * (math.pi / 4)
-					self.ball.vx = -1 * math.cos(ref_angle)
-					self.ball.vy = math.sin(ref_angle)
-					self.ball.speed_up()
-					self.score.last_touch = "right"
-
-		if self.ball.pos_y - self.ball.radius <= self.field.paddle["top"]["y"] + paddleWidth / 2:
-			if not (self.score.last_touch == "top" or self.ball.pos_y - self.ball.radius < self.field.paddle["top"]["y"] - paddleWidth):
-				if self.ball.pos_x + self.ball.radius >= self.field.paddle["top"]["x"] - paddleLen / 2 and \
-					self.ball.pos_x - self.ball.radius <= self.field.paddle["top"]["x"] + paddleLen / 2:
-					
-					ref_angle = (self.ball.pos_x - self.field.paddle["top"]["x"]) / (paddleLen / 2) * (math.pi / 4)
-					self.ball.vx = math.sin(ref_angle)
-					self.ball.vy = math.cos(ref_angle)
-					self.ball.speed_up()
-					self.score.last_touch = "top"
-
-		elif self.ball.pos_y + self.ball.radius >= self.field.paddle["bottom"]["y"] - paddleWidth / 2:
-			if not (self.score.last_touch == "bottom" or self.ball.pos_y + self.ball.radius > self.field.paddle["bottom"]["y"] + paddleWidth):
-				if self.ball.pos_x + self.ball.radius >= self.field.paddle["bottom"]["x"] - paddleLen / 2 and \
-					self.ball.pos_x - self.ball.radius <= self.field.paddle["bottom"]["x"] + paddleLen / 2:
-					
-					ref_angle = (self.ball.pos_x - self.field.paddle["bottom"]["x"]) / (paddleLen / 2) * (math.pi / 4)
-					self.ball.vx = math.sin(ref_angle)
-					self.ball.vy = -math.cos(ref_angle)
-					self.ball.speed_up()
-					self.score.last_touch = "bottom"
-
-	async def move(self):
-		await self.ball.move()
-		await self.field.move()
-
-	async def update(self):
-		await self.check_goal()
-		if self.goal == True:
-			logger.debug("\n\nGOAL")
-			self.old_score = copy.deepcopy(self.score)
-			await self.score.update_score()
-		else:
-			await self.check_collisions()
-			await self.move()
+from .four_player_codec import DELTA, KEYFRAME, frame_kind
+from .four_player_room import Rooms
 
 class handle4PGame(AsyncWebsocketConsumer):
 
-	active_connections = 0
-	active_games = 0
-	used_paddles = []
-	group_name = 'game_group'
-	loop = 0
-
-	data = Data()
-
-	async def game_loop(self):
-		while True:
-			if(handle4PGame.active_connections != 4):
-				return
-			handle4PGame.loop += 1
-			await handle4PGame.data.update()
-			await self.channel_layer.group_send(
-				self.group_name,
-				{
-					'type': 'game_message',
-					'message': json.dumps({
-						'type': 'update_game_data',
-						'loop': handle4PGame.loop,
-						'goal': handle4PGame.data.goal,
-
-						'last_touch': handle4PGame.data.score.last_touch,
-						'conceded': handle4PGame.data.score.conceded,
-						'score_left': handle4PGame.data.score.left,
-						'score_right': handle4PGame.data.score.right,
-						'score_top': handle4PGame.data.score.top,
-						'score_bottom': handle4PGame.data.score.bottom,
-						'old_score_left': handle4PGame.data.old_score.left,
-						'old_score_right': handle4PGame.data.old_score.right,
-						'old_score_top': handle4PGame.data.old_score.top,
-						'old_score_bottom': handle4PGame.data.old_score.bottom,
-						'animation_time_first': handle4PGame.data.animation_time["first"],
-						'animation_time_second': handle4PGame.data.animation_time["second"],
-						'animation_time_third': handle4PGame.data.animation_time["third"],
-
-						'ball_x': handle4PGame.data.ball.pos_x,
-						'ball_y': handle4PGame.data.ball.pos_y,
-						'ball_vx': handle4PGame.data.ball.vx,
-						'ball_vy': handle4PGame.data.ball.vy,
-						'speedx': handle4PGame.data.ball.speedx,
-						'speedy': handle4PGame.data.ball.speedy,
-
-						'left_x': handle4PGame.data.field.paddle["left"]["x"],
-						'left_y': handle4PGame.data.field.paddle["left"]["y"],
-						'right_x': handle4PGame.data.field.paddle["right"]["x"],
-						'right_y': handle4PGame.data.field.paddle["right"]["y"],
-						'top_x': handle4PGame.data.field.paddle["top"]["x"],
-						'top_y': handle4PGame.data.field.paddle["top"]["y"],
-						'bottom_x': handle4PGame.data.field.paddle["bottom"]["x"],
-						'bottom_y': handle4PGame.data.field.paddle["bottom"]["y"]
-					})
-				}
-			)
-			if(self.data.goal == True):
-				await sync_to_async(self.data.ball.initialize)()
-				self.data.goal = False
-				self.data.score.last_touch = ""
-				self.data.score.conceded = ""
-				await asyncio.sleep(1.5)
-			await asyncio.sleep(0.016)
-
-	async def getRandomPaddle():
-		options = ["left", "top", "bottom", "right"]
-		availableOptions = []
-		
-		for side in options:
-			isUsed = False
-			for used in handle4PGame.used_paddles:
-				if side == used:
-					isUsed = True
-			if(isUsed == False):
-				availableOptions.append(side)
-		
-		rand = random.randint(0, 100) % len(availableOptions)
-		paddle = availableOptions[rand]
-		handle4PGame.used_paddles.append(paddle)
-		logger.debug(f"added paddle{paddle}")
-		logger.debug(f"used paddles{handle4PGame.used_paddles}")
-		logger.debug("GETRANDOMPADDLE2")
-		return paddle
-
-	async def initialize(self):
-		self.data.initialize()
-		handle4PGame.active_games = 0
-		handle4PGame.used_paddles = []
-		handle4PGame.loop = 0
+	# 4-player games of this worker, one per challenger
+	rooms = Rooms()
 
 	async def connect(self):
+		self.challenger = self.scope["url_route"]["kwargs"]["challenger"]
+		# clients may opt in to binary frames (see four_player_codec), the
+		# others get them decoded to JSON; the first player of a room may
+		# open it in lockstep mode (see four_player_room)
+		query = parse_qs(self.scope['query_string'].decode())
+		self.binary_frames = query.get('encoding', [''])[0] == 'binary'
+		lockstep = query.get('mode', [''])[0] == 'lockstep'
+		self.room = handle4PGame.rooms.join(self.challenger, lockstep)
+		if self.room is None:
+			await self.accept()
+			await self.send(text_data=json.dumps({
+				'type': 'room_mode_mismatch',
+				'lockstep': not lockstep,
+			}))
+			await self.close()
+			return
+		self.group_name = self.room.group_name
+		self.synced = False
 		await self.accept()
 		await self.channel_layer.group_add(
 			self.group_name,
 			self.channel_name
 		)
-		handle4PGame.active_connections += 1
-		if(handle4PGame.active_connections == 1):
-			await self.initialize()
-			logger.debug("\n\nINITIALIZE NEW GAME\n")
+		self.outbox = FrameOutbox(self.send)
+		self.room.listen(self.game_frame)
+		# a full frame for the newcomer, now that it gets the room's frames
+		self.room.request_keyframe()
 
 	async def receive(self, text_data=None, bytes_data=None):
 		data = json.loads(text_data)
 		type = data.get("type")
+		room = self.room
 
 		if type == "close_socket":
 			await self.channel_layer.group_send(
@@ -846,19 +690,22 @@ class handle4PGame(AsyncWebsocketConsumer):
 				}
 			)
 		elif type == 'active_game':
-			handle4PGame.active_games += 1
-			if(handle4PGame.active_games == 4):
-				handle4PGame.data.initialize()
-				await asyncio.sleep(1.5)
-				asyncio.create_task(self.game_loop())
+			room.active_games += 1
+			if(room.active_games == 4):
+				room.start()
 		elif type == "player_direction":
-			handle4PGame.data.field.paddle[data.get("side")]["dir"] = data.get("dir")
+			paddle = room.data.field.paddle.get(data.get("side"))
+			direction = data.get("dir")
+			if paddle is not None and game_manager.is_direction(direction):
+				paddle.dir = direction
+		elif type == "resync":
+			# a lockstep player whose state hash did not match
+			room.request_keyframe()
 		elif type == "added_paddle":
-			handle4PGame.used_paddles.append(data.get("added_paddle"))
+			room.used_paddles.append(data.get("added_paddle"))
 		elif type == "get_my_paddle":
 			receiver = data.get("sender")
-			logger.debug("GET MY PADDLE CALLED")
-			paddle = await handle4PGame.getRandomPaddle()
+			paddle = room.get_random_paddle()
 			logger.debug(f"GOT PADDLE {paddle}")
 			await self.channel_layer.group_send(
 				self.group_name,
@@ -876,7 +723,7 @@ class handle4PGame(AsyncWebsocketConsumer):
 					'type': 'game_message',
 					'message': json.dumps({
 						"type": "active_connections",
-						"active_connections": str(handle4PGame.active_connections),
+						"active_connections": str(room.connections),
 					})
 				}
 			)
@@ -887,23 +734,39 @@ class handle4PGame(AsyncWebsocketConsumer):
 					'type': 'game_message',
 					'message': json.dumps({
 						"type": "ball",
-						"vx": str(handle4PGame.data.ball.vx),
-						"vy": str(handle4PGame.data.ball.vy),
-						"speedx": str(handle4PGame.data.ball.speedx),
-						"speedy": str(handle4PGame.data.ball.speedy),
+						"vx": str(room.data.ball.vx),
+						"vy": str(room.data.ball.vy),
+						"speedx": str(room.data.ball.speedx),
+						"speedy": str(room.data.ball.speedy),
 					})
 				}
 			)
 
 	async def game_message(self, event):
-		message = event['message']
-		message_data = json.loads(message)
-		await self.send(text_data=message)
+		await self.send(text_data=event['message'])
+
+	async def game_frame(self, frame):
+		# deltas are relative to the last keyframe, so they may be dropped,
+		# unlike lockstep inputs, but neither is of use before a keyframe
+		kind = frame_kind(frame.data)
+		if kind == KEYFRAME:
+			self.synced = True
+		elif not self.synced:
+			return
+		droppable = kind == DELTA
+		if self.binary_frames:
+			self.outbox.put(droppable, bytes_data=frame.data)
+		else:
+			self.outbox.put(droppable, text_data=frame.decoded_text(self.room.decoder))
 
 	async def disconnect(self, close_code):
+		if self.room is None:
+			return
+		self.room.unlisten(self.game_frame)
+		self.outbox.close()
 		await self.channel_layer.group_discard(
 			self.group_name,
 			self.channel_name
 		)
-		logger.debug(f"PLAYER DISCONNECTION active connections: {handle4PGame.active_connections}")
-		handle4PGame.active_connections -= 1
+		logger.debug(f"PLAYER DISCONNECTION room {self.challenger} active connections: {self.room.connections}")
+		handle4PGame.rooms.leave(self.room)
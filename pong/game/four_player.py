@@ -0,0 +1,292 @@
+import logging
+import math
+import random
+import time
+
+# Simulation of the 4-player game. Kept free of Django and Channels so it can
+# be driven headless (see game/benchmark.py); handle4PGame in consumers.py
+# runs it over websockets.
+
+logger = logging.getLogger(__name__)
+
+BALL_SIZE = 4
+BALL_START_SPEED = 2 / 12
+BALL_INCR_SPEED = 1 / 64
+GOAL_LINE = 10
+PADDLE_SPEED = 5
+PADDLE_LEN = 42
+PADDLE_WIDTH = 6
+# Each update() advances the game by 1 / TICK_RATE s; frames are sent
+# SEND_RATE times a second, and on goals.
+TICK_RATE = 60
+SEND_RATE = 20
+SEND_INTERVAL = max(1, round(TICK_RATE / SEND_RATE))
+
+class Rng:
+	"""xorshift32 generator for the serves, simple enough for lockstep
+	clients to reproduce from its state (see four_player_room)."""
+	__slots__ = ("state",)
+
+	def __init__(self, seed=None):
+		self.seed(seed)
+
+	def seed(self, seed=None):
+		if seed is None:
+			seed = random.getrandbits(32)
+		self.state = (seed & 0xffffffff) or 1
+
+	def random(self):
+		x = self.state
+		x ^= (x << 13) & 0xffffffff
+		x ^= x >> 17
+		x ^= (x << 5) & 0xffffffff
+		self.state = x
+		return x / 4294967296
+
+class Ball:
+	__slots__ = ("rng", "radius", "incr_speed", "pos_x", "pos_y", "vx", "vy", "speedx", "speedy")
+
+	def __init__(self, rng):
+		self.rng = rng
+		self.radius = BALL_SIZE / 2 / 200 * 100
+		self.incr_speed = BALL_INCR_SPEED / 200 * 100
+		self.initialize()
+
+	def initialize(self):
+		self.pos_x = 50
+		self.pos_y = 50
+		rand = self.rng.random()
+		if rand < 0.25:
+			self.vx = 1
+			self.vy = 1
+		elif rand < 0.5:
+			self.vx = 1
+			self.vy = -1
+		elif rand < 0.75:
+			self.vx = -1
+			self.vy = 1
+		else:
+			self.vx = -1
+			self.vy = -1
+
+		rand = self.rng.random()
+		if rand <= 0.5:
+			self.speedx = BALL_START_SPEED / 300 * 70
+			self.speedy = BALL_START_SPEED / 200 * 70
+		else:
+			self.speedx = BALL_START_SPEED / 200 * 70
+			self.speedy = BALL_START_SPEED / 300 * 70
+
+	def speed_up(self):
+		self.speedx += self.incr_speed
+		self.speedy += self.incr_speed
+
+	def move(self):
+		# by the distance covered during one update
+		self.pos_x += self.vx * self.speedx * 1000 / TICK_RATE
+		self.pos_y += self.vy * self.speedy * 1000 / TICK_RATE
+
+class Paddle:
+	"""A player's paddle. Left and right paddles are vertical: they block
+	the ball on x and slide on y. sign is the direction of their goal."""
+	__slots__ = ("side", "vertical", "sign", "dir", "x", "y")
+
+	def __init__(self, side, vertical, sign, x, y):
+		self.side = side
+		self.vertical = vertical
+		self.sign = sign
+		self.dir = 0
+		self.x = x
+		self.y = y
+
+class Field:
+	__slots__ = ("paddle_width", "paddle_len", "paddle_speed", "goal_line",
+		"limit_min", "limit_max", "paddle", "paddles")
+
+	def __init__(self):
+		self.initialize()
+
+	def initialize(self):
+		self.paddle_width = PADDLE_WIDTH / 300 * 100
+		self.paddle_len = PADDLE_LEN / 200 * 100
+		self.paddle_speed = PADDLE_SPEED / 200 * 100
+		self.goal_line = GOAL_LINE / 200 * 100
+		self.limit_min = self.paddle_len / 2
+		self.limit_max = 100 - self.paddle_len / 2
+
+		near = self.goal_line + self.paddle_width / 2
+		far = 100 - self.goal_line - self.paddle_width / 2
+		self.paddles = (Paddle("left", True, -1, near, 50),
+			Paddle("right", True, 1, far, 50),
+			Paddle("top", False, -1, 50, near),
+			Paddle("bottom", False, 1, 50, far))
+		# by side
+		self.paddle = {paddle.side: paddle for paddle in self.paddles}
+
+	def move(self):
+		speed = self.paddle_speed
+		limit_min, limit_max = self.limit_min, self.limit_max
+		for paddle in self.paddles:
+			if paddle.dir == 0:
+				continue
+			if paddle.vertical:
+				paddle.y = min(max(paddle.y + speed * paddle.dir, limit_min), limit_max)
+			else:
+				paddle.x = min(max(paddle.x + speed * paddle.dir, limit_min), limit_max)
+
+class Score:
+	__slots__ = ("left", "right", "top", "bottom", "conceded", "last_touch")
+
+	def __init__(self):
+		self.initialize()
+
+	def initialize(self):
+		self.left = 0
+		self.right = 0
+		self.top = 0
+		self.bottom = 0
+		self.conceded = ""
+		self.last_touch = "none"
+
+	def assign(self, other):
+		self.left = other.left
+		self.right = other.right
+		self.top = other.top
+		self.bottom = other.bottom
+		self.conceded = other.conceded
+		self.last_touch = other.last_touch
+
+	def update_score(self):
+		if self.last_touch == "left":
+			self.left += 1
+		elif self.last_touch == "right":
+			self.right += 1
+		elif self.last_touch == "top":
+			self.top += 1
+		elif self.last_touch == "bottom":
+			self.bottom += 1
+
+		if self.conceded.find("left") != -1:
+			self.left -= 1
+		elif self.conceded.find("right") != -1:
+			self.right -= 1
+		elif self.conceded.find("top") != -1:
+			self.top -= 1
+		elif self.conceded.find("bottom") != -1:
+			self.bottom -= 1
+
+class Data:
+	__slots__ = ("rng", "ball", "field", "score", "old_score", "goal", "animation_time")
+
+	def __init__(self, seed=None):
+		self.rng = Rng(seed)
+		self.ball = Ball(self.rng)
+		self.field = Field()
+		self.score = Score()
+		self.old_score = Score()
+		self.goal = False
+		self.animation_time = {"first": 0, "second": 0, "third": 0} # {first: 500, second: 1000, third: 1500};
+
+	def initialize(self):
+		self.ball.initialize()
+		self.field.initialize()
+		self.score.initialize()
+		self.old_score.initialize()
+		self.goal = False
+		self.animation_time = {"first": 0, "second": 0, "third": 0} # {first: 500, second: 1000, third: 1500};
+
+	def check_goal(self):
+		self.score.conceded = ""
+		self.goal = False
+
+		if self.ball.pos_x < 0:
+			self.goal = True
+			self.score.conceded += "left"
+		elif self.ball.pos_x > 100:
+			self.goal = True
+			self.score.conceded += "right"
+
+		if self.ball.pos_y < 0:
+			self.goal = True
+			self.score.conceded += "top"
+		elif self.ball.pos_y > 100:
+			self.goal = True
+			self.score.conceded += "bottom"
+
+		if self.goal == True:
+			current_time = time.time()
+			self.animation_time["first"] = 0.5 + current_time
+			self.animation_time["second"] = 1 + current_time
+			self.animation_time["third"] = 1.5 + current_time
+
+	def check_collisions(self):
+		"""Bounce the ball off a paddle it touches during this update.
+
+		The ball's path over the coming move is swept against the paddle
+		face, so a fast ball cannot skip over the paddle between two updates.
+		On contact the ball is moved to the contact point before bouncing.
+		"""
+		ball = self.ball
+		radius = ball.radius
+		half_width = self.field.paddle_width / 2
+		half_len = self.field.paddle_len / 2
+		step_x = ball.vx * ball.speedx * 1000 / TICK_RATE
+		step_y = ball.vy * ball.speedy * 1000 / TICK_RATE
+
+		for paddle in self.field.paddles:
+			if self.score.last_touch == paddle.side:
+				continue
+			sign = paddle.sign
+			# the axis the paddle blocks, and the one it slides on
+			if paddle.vertical:
+				pos, step, face_pos = ball.pos_x, step_x, paddle.x
+				along, step_along, paddle_along = ball.pos_y, step_y, paddle.y
+			else:
+				pos, step, face_pos = ball.pos_y, step_y, paddle.y
+				along, step_along, paddle_along = ball.pos_x, step_x, paddle.x
+
+			edge = pos + sign * radius
+			face = face_pos - sign * half_width
+			depth = (edge - face) * sign
+			if depth >= 0:
+				if (edge - face_pos - sign * 2 * half_width) * sign > 0:
+					# already past the paddle
+					continue
+				t = 0
+			elif step * sign > 0 and depth + step * sign >= 0:
+				t = -depth / (step * sign)
+			else:
+				continue
+
+			contact = along + step_along * t
+			if contact + radius < paddle_along - half_len or \
+				contact - radius > paddle_along + half_len:
+				continue
+
+			ref_angle = (contact - paddle_along) / half_len * (math.pi / 4)
+			if paddle.vertical:
+				ball.pos_x, ball.pos_y = pos + step * t, contact
+				ball.vx = -sign * math.cos(ref_angle)
+				ball.vy = math.sin(ref_angle)
+			else:
+				ball.pos_x, ball.pos_y = contact, pos + step * t
+				ball.vx = math.sin(ref_angle)
+				ball.vy = -sign * math.cos(ref_angle)
+			ball.speed_up()
+			self.score.last_touch = paddle.side
+			step_x = ball.vx * ball.speedx * 1000 / TICK_RATE
+			step_y = ball.vy * ball.speedy * 1000 / TICK_RATE
+
+	def move(self):
+		self.ball.move()
+		self.field.move()
+
+	def update(self):
+		self.check_goal()
+		if self.goal == True:
+			logger.debug("\n\nGOAL")
+			self.old_score.assign(self.score)
+			self.score.update_score()
+		else:
+			self.check_collisions()
+			self.move()
@@ -0,0 +1,218 @@
+import struct
+import zlib
+
+# Binary encoding of 4-player update_game_data frames. A frame is a header
+# followed by the values of the fields set in its mask, in FIELDS order:
+#
+#   version, kind, loop, server time, field mask
+#
+# A keyframe carries every field. A delta only carries the fields that
+# differ from the last keyframe, so a client applies it over its copy of the
+# keyframe, and can skip deltas (a slow connection drops them, see
+# FrameOutbox) without missing a change. Keyframes are sent every
+# keyframe_interval ticks, on goals and when a player (re)connects.
+#
+# Rooms in lockstep mode send an inputs frame every tick instead, once the
+# players have a keyframe: version, kind, loop and the direction of each
+# paddle (in Field.paddles order) during that tick, plus, every few ticks,
+# the state_hash of the state after it.
+#
+# Every kind of frame starts with FORMAT_VERSION, bumped whenever FIELDS or
+# a frame layout changes: a delta read with another FIELDS list would land
+# its values on the wrong fields, so FrameDecoder and the web client reject
+# the frames of other versions rather than guess.
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<BBIdI')
+INPUTS = struct.Struct('<BBIbbbb')
+STATE_HASH = struct.Struct('<I')
+KEYFRAME, DELTA, INPUTS_FRAME, HASHED_INPUTS_FRAME = range(4)
+
+FIELDS = (
+	('goal', '?'),
+	('last_touch', 'B'),
+	('conceded', 'B'),
+	('score_left', 'h'),
+	('score_right', 'h'),
+	('score_top', 'h'),
+	('score_bottom', 'h'),
+	('old_score_left', 'h'),
+	('old_score_right', 'h'),
+	('old_score_top', 'h'),
+	('old_score_bottom', 'h'),
+	('animation_time_first', 'd'),
+	('animation_time_second', 'd'),
+	('animation_time_third', 'd'),
+	('ball_x', 'f'),
+	('ball_y', 'f'),
+	('ball_vx', 'f'),
+	('ball_vy', 'f'),
+	('speedx', 'f'),
+	('speedy', 'f'),
+	('left_x', 'f'),
+	('left_y', 'f'),
+	('right_x', 'f'),
+	('right_y', 'f'),
+	('top_x', 'f'),
+	('top_y', 'f'),
+	('bottom_x', 'f'),
+	('bottom_y', 'f'),
+	('serve_loop', 'I'),
+	('rng', 'I'),
+)
+FIELD_STRUCTS = tuple(struct.Struct('<' + fmt) for _, fmt in FIELDS)
+ALL_FIELDS = (1 << len(FIELDS)) - 1
+# the fields of the simulation, which lockstep clients must agree on
+HASHED_FIELDS = tuple(
+	index for index, (name, _) in enumerate(FIELDS)
+	if not name.startswith('animation_time'))
+
+# last_touch is a code, conceded a bit per side (a corner goal concedes two)
+TOUCHES = ('', 'none', 'left', 'right', 'top', 'bottom')
+TOUCH_CODES = {touch: code for code, touch in enumerate(TOUCHES)}
+CONCEDED_SIDES = ('left', 'right', 'top', 'bottom')
+
+
+def frame_values(data, serve_loop=0):
+	"""The FIELDS values of a four_player.Data, served at serve_loop."""
+	score, old_score = data.score, data.old_score
+	ball, paddle = data.ball, data.field.paddle
+	left, right, top, bottom = (
+		paddle['left'], paddle['right'], paddle['top'], paddle['bottom'])
+	conceded = 0
+	for bit, side in enumerate(CONCEDED_SIDES):
+		if side in score.conceded:
+			conceded |= 1 << bit
+	return (
+		data.goal,
+		TOUCH_CODES.get(score.last_touch, 0),
+		conceded,
+		score.left, score.right, score.top, score.bottom,
+		old_score.left, old_score.right, old_score.top, old_score.bottom,
+		data.animation_time['first'],
+		data.animation_time['second'],
+		data.animation_time['third'],
+		ball.pos_x, ball.pos_y, ball.vx, ball.vy, ball.speedx, ball.speedy,
+		left.x, left.y, right.x, right.y,
+		top.x, top.y, bottom.x, bottom.y,
+		serve_loop, data.rng.state,
+	)
+
+
+def load_frame(data, frame):
+	"""Set a four_player.Data to a decoded frame (see FrameDecoder)."""
+	score, old_score = data.score, data.old_score
+	data.goal = frame['goal']
+	score.last_touch = frame['last_touch']
+	score.conceded = frame['conceded']
+	for side in CONCEDED_SIDES:
+		setattr(score, side, frame[f'score_{side}'])
+		setattr(old_score, side, frame[f'old_score_{side}'])
+		paddle = data.field.paddle[side]
+		paddle.x = frame[f'{side}_x']
+		paddle.y = frame[f'{side}_y']
+	for key in data.animation_time:
+		data.animation_time[key] = frame[f'animation_time_{key}']
+	ball = data.ball
+	ball.pos_x, ball.pos_y = frame['ball_x'], frame['ball_y']
+	ball.vx, ball.vy = frame['ball_vx'], frame['ball_vy']
+	ball.speedx, ball.speedy = frame['speedx'], frame['speedy']
+	data.rng.state = frame['rng']
+
+
+def state_hash(data, serve_loop=0):
+	"""CRC32 of the simulation state of a four_player.Data, as encoded."""
+	values = frame_values(data, serve_loop)
+	return zlib.crc32(b''.join(
+		FIELD_STRUCTS[index].pack(values[index]) for index in HASHED_FIELDS))
+
+
+def encode_inputs(loop, data, state_hash=None):
+	"""The lockstep inputs frame of the tick loop of a four_player.Data."""
+	left, right, top, bottom = (paddle.dir for paddle in data.field.paddles)
+	if state_hash is None:
+		return INPUTS.pack(FORMAT_VERSION, INPUTS_FRAME, loop, left, right, top, bottom)
+	return (INPUTS.pack(FORMAT_VERSION, HASHED_INPUTS_FRAME, loop, left, right, top, bottom)
+			+ STATE_HASH.pack(state_hash))
+
+
+class FrameEncoder:
+	"""Encodes the frames of one room against its last keyframe."""
+
+	def __init__(self, keyframe_interval=60):
+		self.keyframe_interval = keyframe_interval
+		self.keyframe = None
+		self.keyframe_loop = 0
+
+	def request_keyframe(self):
+		self.keyframe = None
+
+	def encode(self, loop, server_time, values, keyframe=False):
+		if (keyframe or self.keyframe is None
+				or loop - self.keyframe_loop >= self.keyframe_interval):
+			self.keyframe = values
+			self.keyframe_loop = loop
+			kind, mask = KEYFRAME, ALL_FIELDS
+			parts = [field.pack(value) for field, value in zip(FIELD_STRUCTS, values)]
+		else:
+			kind, mask, parts = DELTA, 0, []
+			for index, (field, value, base) in enumerate(
+					zip(FIELD_STRUCTS, values, self.keyframe)):
+				if value != base:
+					mask |= 1 << index
+					parts.append(field.pack(value))
+		return HEADER.pack(FORMAT_VERSION, kind, loop, server_time, mask) + b''.join(parts)
+
+
+def frame_kind(data):
+	return data[1]
+
+
+class FrameDecoder:
+	"""Decodes the frames of one room to update_game_data messages."""
+
+	def __init__(self):
+		self.keyframe = None
+
+	def decode(self, data):
+		"""Return the frame as a dict of every field, or None for a delta
+		received before any keyframe. Inputs frames are returned as
+		lockstep_inputs messages."""
+		if not data or data[0] != FORMAT_VERSION:
+			raise ValueError("Unsupported 4-player frame format")
+		if data[1] in (INPUTS_FRAME, HASHED_INPUTS_FRAME):
+			return decode_inputs(data)
+		_, kind, loop, server_time, mask = HEADER.unpack_from(data)
+		if kind == DELTA and self.keyframe is None:
+			return None
+		values = {}
+		offset = HEADER.size
+		for index, ((name, _), field) in enumerate(zip(FIELDS, FIELD_STRUCTS)):
+			if mask & (1 << index):
+				values[name] = field.unpack_from(data, offset)[0]
+				offset += field.size
+		if kind == KEYFRAME:
+			self.keyframe = values
+		else:
+			values = {**self.keyframe, **values}
+		conceded = values['conceded']
+		return {
+			'type': 'update_game_data',
+			'loop': loop,
+			'server_time': server_time,
+			**values,
+			'last_touch': TOUCHES[values['last_touch']],
+			'conceded': ''.join(side for bit, side in enumerate(CONCEDED_SIDES)
+								if conceded & (1 << bit)),
+		}
+
+
+def decode_inputs(data):
+	_, kind, loop, *directions = INPUTS.unpack_from(data)
+	message = {
+		'type': 'lockstep_inputs',
+		'loop': loop,
+		**dict(zip(CONCEDED_SIDES, directions)),
+	}
+	if kind == HASHED_INPUTS_FRAME:
+		message['hash'] = STATE_HASH.unpack_from(data, INPUTS.size)[0]
+	return message
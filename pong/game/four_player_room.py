@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import random
+import time
+
+from .four_player import Data, TICK_RATE, SEND_INTERVAL
+from .four_player_codec import (
+	FrameDecoder, FrameEncoder, encode_inputs, frame_values, load_frame, state_hash)
+from .game_feed import Frame
+
+# 4-player games of a worker, one room per challenger: each room has its
+# own simulation, paddle assignment, connections and game loop. handle4PGame
+# in consumers.py joins players to rooms; like the simulation, rooms are
+# kept free of Django and Channels.
+#
+# In lockstep mode, the players simulate the game themselves: after a
+# keyframe, a room only sends the inputs of each tick, with a hash of the
+# state every HASH_INTERVAL ticks for them to check they did not drift
+# (they ask for a keyframe if they did). The simulation only depends on
+# the inputs, the serve tick and the state of the seeded Rng.
+
+logger = logging.getLogger(__name__)
+
+SIDES = ("left", "top", "bottom", "right")
+# Seconds the ball waits after a goal, and before the first serve
+GOAL_PAUSE = 1.5
+START_DELAY = 1.5
+# Ticks a late loop runs back to back to catch up; beyond that the missed
+# ticks are skipped, and the game slows down instead of bursting
+MAX_CATCH_UP = 5
+# Ticks between two keyframes (see four_player_codec)
+KEYFRAME_INTERVAL = TICK_RATE
+# Ticks between two state hashes in lockstep mode
+HASH_INTERVAL = 15
+
+class Room:
+	def __init__(self, name, publish=None, lockstep=False):
+		self.name = name
+		self.lockstep = lockstep
+		self.group_name = f"game4p_{name}"
+		# await publish(group_name, data) sends a frame to the room, by
+		# default to the listeners of this room object
+		self.publish = publish or self.deliver
+		self.listeners = set()
+		self.data = Data()
+		self.connections = 0
+		self.active_games = 0
+		self.used_paddles = []
+		self.loop = 0
+		# first tick the ball moves again after a goal or the start
+		self.serve_loop = 0
+		self.encoder = FrameEncoder(KEYFRAME_INTERVAL)
+		# decodes each frame once for all the JSON clients of the room
+		# (see Frame.decoded_text)
+		self.decoder = FrameDecoder()
+		# a keyframe is due in lockstep mode
+		self.resync = True
+		self.task = None
+		self.late_ticks = 0
+		self.skipped_ticks = 0
+		self.max_lag = 0
+		self.tick_errors = 0
+
+	def initialize(self):
+		self.data.initialize()
+		self.active_games = 0
+		self.used_paddles = []
+		self.loop = 0
+		self.serve_loop = 0
+		self.request_keyframe()
+
+	def get_random_paddle(self):
+		available = [side for side in SIDES if side not in self.used_paddles]
+		paddle = available[random.randint(0, 100) % len(available)]
+		self.used_paddles.append(paddle)
+		logger.debug(f"room {self.name} used paddles {self.used_paddles}")
+		return paddle
+
+	def request_keyframe(self):
+		self.encoder.request_keyframe()
+		self.resync = True
+
+	@property
+	def paused(self):
+		return self.loop < self.serve_loop
+
+	def start(self, delay=START_DELAY):
+		"""Start the game loop, unless it runs already. The ball is served
+		after delay seconds."""
+		if self.task is not None and not self.task.done():
+			return
+		self.data.initialize()
+		self.loop = 0
+		self.serve_loop = round(delay * TICK_RATE)
+		self.request_keyframe()
+		self.task = asyncio.create_task(self.run())
+
+	def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			self.task = None
+
+	def tick(self):
+		"""Advance the game by one tick and return the frame to send, if one
+		is due."""
+		self.loop += 1
+		data = self.data
+		frame = None
+		if not self.paused:
+			data.update()
+			if not self.lockstep and (data.goal or self.loop % SEND_INTERVAL == 0):
+				frame = self.frame()
+			if data.goal:
+				data.ball.initialize()
+				data.goal = False
+				data.score.last_touch = ""
+				data.score.conceded = ""
+				self.serve_loop = self.loop + 1 + round(GOAL_PAUSE * TICK_RATE)
+		if self.lockstep:
+			frame = self.lockstep_frame()
+		return frame
+
+	def lockstep_frame(self):
+		"""The inputs of the tick, or a keyframe of the state after it if
+		one is due."""
+		if self.resync:
+			frame = self.frame(keyframe=True)
+			# players start from the keyframe, in single precision: so does
+			# the room, for their simulation to match it exactly
+			self.load(FrameDecoder().decode(frame))
+			return frame
+		if self.loop % HASH_INTERVAL:
+			return encode_inputs(self.loop, self.data)
+		return encode_inputs(self.loop, self.data, state_hash(self.data, self.serve_loop))
+
+	def load(self, frame):
+		"""Set the game to a decoded keyframe."""
+		load_frame(self.data, frame)
+		self.loop = frame['loop']
+		self.serve_loop = frame['serve_loop']
+		self.resync = False
+
+	async def run(self):
+		"""Tick at TICK_RATE against a monotonic deadline while the room is
+		full, whatever the time spent ticking and publishing."""
+		event_loop = asyncio.get_running_loop()
+		interval = 1 / TICK_RATE
+		deadline = event_loop.time()
+		while self.connections == 4:
+			deadline += interval
+			try:
+				frame = self.tick()
+				if frame is not None:
+					# encoded once and handed to every player; loop and
+					# server_time let clients interpolate
+					await self.publish(self.group_name, frame)
+			except Exception:
+				self.tick_errors += 1
+				logger.exception(f"Error ticking 4-player room {self.name}")
+				# the players may have missed a frame the next ones build on
+				self.request_keyframe()
+			now = event_loop.time()
+			if now > deadline:
+				lag = now - deadline
+				self.late_ticks += 1
+				self.max_lag = max(self.max_lag, lag)
+				missed = int(lag // interval)
+				if missed > MAX_CATCH_UP:
+					self.skipped_ticks += missed
+					deadline += missed * interval
+			await asyncio.sleep(max(0, deadline - now))
+
+	def listen(self, callback):
+		"""Call await callback(frame) with a Frame for every frame of the
+		room, until unlisten."""
+		self.listeners.add(callback)
+
+	def unlisten(self, callback):
+		self.listeners.discard(callback)
+
+	async def deliver(self, group_name, data):
+		# the players of a room are connected to the worker running it, so
+		# its frames go straight to them rather than through Redis
+		frame = Frame(data)
+		results = await asyncio.gather(
+			*(callback(frame) for callback in list(self.listeners)),
+			return_exceptions=True)
+		for result in results:
+			if isinstance(result, Exception):
+				logger.error(f"Error delivering frame in room {self.name}: {result}")
+
+	def stats(self):
+		return {
+			'ticks': self.loop,
+			'late_ticks': self.late_ticks,
+			'skipped_ticks': self.skipped_ticks,
+			'max_lag': self.max_lag,
+			'tick_errors': self.tick_errors,
+		}
+
+	def frame(self, keyframe=False):
+		# goals are keyframes, clients must not miss them
+		data = self.data
+		return self.encoder.encode(
+			self.loop, time.monotonic(), frame_values(data, self.serve_loop),
+			keyframe=keyframe or data.goal)
+
+class Rooms:
+	"""The rooms of a worker by name; a room is set up by its first
+	connection and goes away with its last one."""
+
+	def __init__(self, publish=None):
+		self.publish = publish
+		self.rooms = {}
+
+	def __len__(self):
+		return len(self.rooms)
+
+	def join(self, name, lockstep=False):
+		"""Join the room name, created in lockstep mode or not by its first
+		connection, or return None if it runs in the other mode: players
+		that do not run the simulation would freeze in a lockstep room."""
+		room = self.rooms.get(name)
+		if room is not None and room.lockstep != lockstep:
+			return None
+		if room is None:
+			room = self.rooms[name] = Room(name, self.publish, lockstep)
+		room.connections += 1
+		if room.connections == 1:
+			room.initialize()
+			logger.debug(f"new 4-player game in room {name}")
+		return room
+
+	def leave(self, room):
+		room.connections -= 1
+		if room.connections <= 0:
+			room.stop()
+			if self.rooms.get(room.name) is room:
+				del self.rooms[room.name]
+				logger.info(f"4-player room {room.name} closed: {room.stats()}")
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+from collections import deque
+
+from .state_codec import decode_game_state
+
+logger = logging.getLogger(__name__)
+
+# Pub/sub channels game frames are published on, followed by the game id:
+# every frame for players, a slower and possibly delayed stream for
+# spectators.
+CHANNEL_PREFIX = 'game:'
+SPECTATOR_PREFIX = 'spectate:'
+
+
+class Frame:
+    """A published frame, shared by every local listener of its game.
+
+    Game frames are state_codec bytes, 4-player frames four_player_codec
+    bytes (forwarded through data, or decoded_text). The decoded state and
+    the JSON text sent to websocket clients are computed once, on first use,
+    however many consumers forward the frame.
+    """
+
+    __slots__ = ('data', '_state', '_text')
+
+    def __init__(self, data):
+        self.data = data
+        self._state = None
+        self._text = None
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = decode_game_state(self.data)
+        return self._state
+
+    @property
+    def text(self):
+        if self._text is None:
+            if self.data.startswith(b'{'):
+                self._text = self.data.decode()
+            else:
+                self._text = json.dumps({
+                    'type': 'game_state',
+                    'game_state': self.state,
+                })
+        return self._text
+
+    def decoded_text(self, decoder):
+        """The JSON text of a 4-player frame, decoded once by decoder, the
+        FrameDecoder shared by the listeners of its room."""
+        if self._text is None:
+            self._text = json.dumps(decoder.decode(self.data))
+        return self._text
+
+
+class GameFeed:
+    """Redis pub/sub delivery of game frames to the consumers of a worker.
+
+    The worker ticking a game publishes each frame once on game:<game_id>
+    (see GameManager.publish_frames and the Lua scripts), encoded with
+    state_codec, and the spectator stream on spectate:<game_id>. Each worker
+    holds a single subscription connection shared by all its consumers: a
+    channel is subscribed while at least one local consumer listens to it,
+    and every frame is handed to each of its listeners as it arrives, as a
+    single Frame. Other channels, like the live games changes, are
+    subscribed to by name with subscribe_channel.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = None
+        self.listeners = {}
+        self.reader_task = None
+
+    @staticmethod
+    def channel(game_id, spectator=False):
+        prefix = SPECTATOR_PREFIX if spectator else CHANNEL_PREFIX
+        return f"{prefix}{game_id}"
+
+    async def publish(self, game_id, data):
+        await self.client.publish(self.channel(game_id), data)
+
+    async def subscribe(self, game_id, callback, spectator=False):
+        """Call await callback(frame) with a Frame for every frame of the
+        game, or of its spectator stream."""
+        await self.subscribe_channel(self.channel(game_id, spectator), callback)
+
+    async def unsubscribe(self, game_id, callback, spectator=False):
+        await self.unsubscribe_channel(self.channel(game_id, spectator), callback)
+
+    async def subscribe_channel(self, channel, callback):
+        listeners = self.listeners.setdefault(channel, set())
+        listeners.add(callback)
+        if len(listeners) > 1:
+            return
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(channel)
+        if self.reader_task is None or self.reader_task.done():
+            self.reader_task = asyncio.create_task(self.run_reader())
+
+    async def unsubscribe_channel(self, channel, callback):
+        listeners = self.listeners.get(channel)
+        if not listeners:
+            return
+        listeners.discard(callback)
+        if not listeners:
+            del self.listeners[channel]
+            await self.pubsub.unsubscribe(channel)
+
+    async def run_reader(self):
+        while self.listeners:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message['type'] != 'message':
+                    continue
+                await self.dispatch(message['channel'].decode(), message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error reading game frames: {e}")
+                await asyncio.sleep(1)
+        self.reader_task = None
+
+    async def dispatch(self, channel, data):
+        listeners = list(self.listeners.get(channel, ()))
+        frame = Frame(data)
+        results = await asyncio.gather(
+            *(callback(frame) for callback in listeners),
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error delivering frame on {channel}: {result}")
+
+
+class FrameOutbox:
+    """Outgoing frames of one websocket connection, latest wins.
+
+    A droppable frame still waiting to be sent is replaced by the next one,
+    so a slow client holds at most one pending state frame and always gets
+    the freshest state once it catches up. Frames put with droppable=False
+    (status changes) are never replaced or dropped.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.dropped = 0
+
+    def put(self, droppable=True, **message):
+        """Queue send(**message), e.g. put(text_data=...)."""
+        if self.items and self.items[-1][0]:
+            self.items[-1] = (droppable, message)
+            self.dropped += 1
+        else:
+            self.items.append((droppable, message))
+        self.ready.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.items:
+                _, message = self.items.popleft()
+                try:
+                    await self.send(**message)
+                except Exception as e:
+                    logger.error(f"Error sending frame: {e}")
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.items.clear()
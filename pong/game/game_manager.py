@@ -1,17 +1,42 @@
 import math
 import time
 import json
-import redis
 import asyncio
+import weakref
+from collections import deque
+import redis.asyncio as redis
 import logging
 
+from .batch_physics import BatchPhysics
+from .game_feed import GameFeed
+from .live_games import LiveGames
+from .replays import ReplayRecorder
+from .sharding import GameLeases
+from .state_codec import (
+    encode_game_state, decode_game_state, PLAYER_CODES)
+from . import redis_scripts
+
 logger = logging.getLogger(__name__)
 
 
 class GameManager:
-    def __init__(self, host='redis', port=6379, db=0):
-        self.client = redis.StrictRedis(
-            host=host, port=port, db=db, decode_responses=True)
+    def __init__(self, host='redis', port=6379, db=0, in_memory=True,
+                 checkpoint_interval=32, physics='scalar', max_connections=32,
+                 sharded=True, lease_ttl=5.0, clock=time.time, publish=True,
+                 spectator_rate=10, spectator_delay=0.0,
+                 replay_keyframe_interval=5.0, tick_rate=60, send_rate=20,
+                 client=None):
+        # One bounded pool shared by every coroutine using the manager;
+        # callers wait for a free connection instead of opening new ones.
+        # Tests pass their own client instead.
+        if client is None:
+            self.pool = redis.BlockingConnectionPool(
+                host=host, port=port, db=db, max_connections=max_connections)
+            client = redis.Redis(connection_pool=self.pool)
+        self.client = client
+        # Source of game timestamps; replaced by a simulated clock when the
+        # engine is driven headless (see benchmark.py).
+        self.clock = clock
 
         self.arena_height = 100  # half height
         self.arena_width = 150  # half width
@@ -23,60 +48,559 @@ class GameManager:
         self.max_speed = 20
         self.flip = False
         self.prev_score = False
-        self.target_fps = 32
-        self.update_interval = 1 / self.target_fps
-        self.lock = asyncio.Lock()
-        self.update_tasks = {}
-
-    def clear_game_state(self, game_id):
-        self.client.delete(game_id)
-        if game_id in self.update_tasks:
-            self.update_tasks[game_id].cancel()
-            del self.update_tasks[game_id]
-
-    def get_game_state(self, game_id):
-        game_state = self.client.get(game_id)
-        if game_state:
-            return json.loads(game_state)
-        return None
-
-    def set_game_state(self, game_id, game_state):
+        # Speeds are in arena units per 1/32 s, whatever the tick rate.
+        self.speed_scale = 32
+        # Games are simulated tick_rate times a second and their frames
+        # sent send_rate times a second (every send_interval ticks), plus
+        # every status change; clients interpolate between frames using
+        # their tick and server_time.
+        self.tick_rate = tick_rate
+        self.update_interval = 1 / tick_rate
+        self.send_rate = send_rate
+        self.send_interval = max(1, round(tick_rate / send_rate))
+        # In-memory games are spread over the send_interval ticks (their
+        # send phase), so that each tick publishes a share of the frames.
+        self.send_phases = {}
+        self.send_groups = [set() for _ in range(self.send_interval)]
+        self.next_send_phase = 0
+
+        # Games are independent, so there is no global lock. In-memory state
+        # is only mutated by synchronous code on the event loop (ticks and
+        # inputs never await mid-update), which makes every mutation atomic
+        # and lets readers use get_game_state without locking. Operations
+        # on one game that span awaits take that game's lock; locks are
+        # dropped from the registry as soon as nobody holds or waits on them.
+        self.game_locks = weakref.WeakValueDictionary()
+
+        # A single scheduler task ticks every active game once per frame.
+        # Games where nothing can move (not running, paddles at rest) are
+        # put to sleep: the in-memory engine skips them until a command
+        # wakes them up, the Redis engine only polls them every
+        # idle_tick_divisor frames. Neither writes a state that did not
+        # change.
+        self.active_games = set()
+        self.awake_games = set()
+        self.idle_tick_divisor = 8
+        self.scheduler_task = None
+        self.tick_count = 0
+        self.overruns = 0
+        self.skipped_frames = 0
+        self.max_lag = 0
+        self.last_tick_duration = 0
+        self.tick_errors = 0
+        # seconds between two scheduler_stats lines in the log
+        self.stats_interval = 60
+
+        # When in_memory is set, running games live in self.games and are
+        # the source of truth; Redis only receives checkpoints every
+        # checkpoint_interval ticks and on status transitions.
+        self.in_memory = in_memory
+        self.checkpoint_interval = checkpoint_interval
+        self.games = {}
+        self.ticks_since_checkpoint = {}
+        self.pending_checkpoints = set()
+        # Moves are queued as they arrive and applied at the start of the
+        # next tick, in order; each player's last applied input seq is
+        # echoed in the frames so clients can reconcile their prediction.
+        self.pending_inputs = []
+
+        # physics='numpy' steps all in-memory games at once with
+        # BatchPhysics; the scalar step_game_state stays the reference.
+        if physics == 'numpy' and not in_memory:
+            raise ValueError("Batch physics requires the in-memory engine")
+        self.batch = BatchPhysics(self) if physics == 'numpy' else None
+        # Awake games whose state dict lags their BatchPhysics slot: dicts
+        # are only written back when a game is published, checkpointed,
+        # scores or is read (see sync_games).
+        self.batch_stale = set()
+
+        # Atomic mutations used when Redis holds the authoritative state
+        self.set_player_dx_script = self.client.register_script(
+            redis_scripts.SET_PLAYER_DX)
+        self.set_player_ready_script = self.client.register_script(
+            redis_scripts.SET_PLAYER_READY)
+        self.forfeit_game_script = self.client.register_script(
+            redis_scripts.FORFEIT_GAME)
+        self.commit_tick_script = self.client.register_script(
+            redis_scripts.COMMIT_TICK)
+
+        # With sharding, a worker only ticks games it holds a lease on and
+        # takes over games whose owner stopped renewing its lease.
+        self.leases = GameLeases(self.client, ttl=lease_ttl) if sharded else None
+
+        # The worker ticking a game is the only one sending its frames: once
+        # per send_interval ticks, and right away on transitions, to the
+        # game's pub/sub channel. Consumers receive them through the
+        # worker's feed. Games whose status changed since the last frames
+        # were sent are kept in transitions.
+        self.publish = publish
+        self.feed = GameFeed(self.client)
+        self.transitions = set()
+        # Spectators get their own, slower stream: one frame every
+        # spectator_interval ticks (a multiple of send_interval) plus every
+        # status change, optionally spectator_delay seconds late.
+        self.spectator_interval = self.send_interval * max(
+            1, round(send_rate / spectator_rate))
+        self.spectator_delay = spectator_delay
+        self.spectator_backlog = deque()
+        self.spectated_status = {}
+        # The live games directory follows the frames published.
+        self.live = LiveGames(self.client)
+        # Replays of the games set up here, recorded from their inputs and
+        # frames and stored under replay:<game_id> when the game ends, which
+        # is announced on replay-stored:<game_id> (see wait_for_replay).
+        self.replays = {}
+        self.replay_keyframe_interval = replay_keyframe_interval
+        self.replay_ttl = 3600
+        self.replay_wait_timeout = 10.0
+        self.lease_ttl = lease_ttl
+        self.lease_task = None
+
+    def game_lock(self, game_id):
+        lock = self.game_locks.get(game_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.game_locks[game_id] = lock
+        return lock
+
+    def drop_game(self, game_id):
+        self.games.pop(game_id, None)
+        self.batch_stale.discard(game_id)
+        phase = self.send_phases.pop(game_id, None)
+        if phase is not None:
+            self.send_groups[phase].discard(game_id)
+        self.ticks_since_checkpoint.pop(game_id, None)
+        self.pending_checkpoints.discard(game_id)
+        self.transitions.discard(game_id)
+        self.active_games.discard(game_id)
+        self.awake_games.discard(game_id)
+        self.spectated_status.pop(game_id, None)
+        self.live.listed.pop(game_id, None)
+        self.replays.pop(game_id, None)
+        if self.batch is not None:
+            self.batch.remove(game_id)
+
+    async def clear_game_state(self, game_id):
+        async with self.game_lock(game_id):
+            self.drop_game(game_id)
+            await self.client.delete(game_id)
+            await self.live.forget(game_id)
+            if self.leases is not None:
+                await self.leases.forget(game_id)
+
+    async def get_game_state(self, game_id):
+        if game_id in self.games:
+            self.sync_games((game_id,))
+            return self.games[game_id]
+        return self.load_game_state(await self.client.get(game_id))
+
+    def load_game_state(self, raw):
+        if not raw:
+            return None
+        if raw.startswith(b'{'):
+            # written by an older worker in the JSON format
+            return json.loads(raw)
+        return decode_game_state(raw)
+
+    async def set_game_state(self, game_id, game_state):
         # if game_state['status'] == 'starting' or game_state['status'] == 'paused':
         #     if game_state['player1']['ready'] and game_state['player2']['ready']:
         #         game_state['status'] = 'running'
-        self.client.set(game_id, json.dumps(game_state))
+        await self.client.set(game_id, encode_game_state(game_state))
+
+    def store_game_state(self, game_id, game_state, transition=False,
+                         sync_batch=True, ticks=1):
+        """Keep a mutated state of the in-memory engine, ticks ticks after
+        the last one.
+
+        The state is only checkpointed to Redis on transitions or once every
+        checkpoint_interval ticks; checkpoints are queued and written in one
+        pipeline by flush_checkpoints().
+        """
+        if game_id not in self.send_phases:
+            phase = self.next_send_phase
+            self.next_send_phase = (phase + 1) % self.send_interval
+            self.send_phases[game_id] = phase
+            self.send_groups[phase].add(game_id)
+        self.games[game_id] = game_state
+        if sync_batch and self.batch is not None:
+            self.batch.load(game_id, game_state)
+        if transition:
+            self.transitions.add(game_id)
+        ticks += self.ticks_since_checkpoint.get(game_id, 0)
+        if transition or ticks >= self.checkpoint_interval:
+            self.checkpoint(game_id)
+        else:
+            self.ticks_since_checkpoint[game_id] = ticks
+
+    def checkpoint(self, game_id):
+        self.pending_checkpoints.add(game_id)
+        self.ticks_since_checkpoint[game_id] = 0
+
+    async def flush_checkpoints(self):
+        if not self.pending_checkpoints:
+            return
+        game_ids, self.pending_checkpoints = self.pending_checkpoints, set()
+        self.sync_games(game_ids)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for game_id in game_ids:
+                game_state = self.games.get(game_id)
+                if game_state is not None:
+                    pipe.set(game_id, encode_game_state(game_state))
+            await pipe.execute()
 
-    def reset_game_state(self, game_id, score_limit=11):
+    async def reset_game_state(self, game_id, score_limit=11):
         initial_state = {
             'status': 'starting',
-            'player1': {'x': 0, 'dx': 0, 'ready': False},
-            'player2': {'x': 0, 'dx': 0, 'ready': False},
+            'player1': {'x': 0, 'dx': 0, 'ready': False, 'seq': 0},
+            'player2': {'x': 0, 'dx': 0, 'ready': False, 'seq': 0},
             'ball': {'x': 0, 'y': 0, 'dx': 0, 'dy': 0, 'v': self.ball_speed},
             'score': {'p1': 0, 'p2': 0, 'limit': score_limit},
-            'timestamp': time.time()
+            'timestamp': self.clock()
         }
-        self.set_game_state(game_id, initial_state)
-        self.start_game_update_task(game_id)
+        async with self.game_lock(game_id):
+            if self.leases is not None and not await self.leases.claim(game_id):
+                # already set up and ticked by the worker owning the game
+                return
+            self.replays[game_id] = ReplayRecorder(self.replay_keyframe_interval)
+            if self.in_memory:
+                self.store_game_state(game_id, initial_state, transition=True)
+                await self.flush_checkpoints()
+            else:
+                await self.set_game_state(game_id, initial_state)
+            self.start_game_update_task(game_id)
 
     def start_game_update_task(self, game_id):
-        if game_id not in self.update_tasks:
-            self.update_tasks[game_id] = asyncio.create_task(
-                self.update_game_state_task(game_id))
+        self.active_games.add(game_id)
+        self.wake_game(game_id)
+        if self.scheduler_task is None or self.scheduler_task.done():
+            self.scheduler_task = asyncio.create_task(self.run_scheduler())
+        self.ensure_lease_keeper()
 
-    async def update_game_state_task(self, game_id):
+    def ensure_lease_keeper(self):
+        if self.leases is None:
+            return
+        if self.lease_task is None or self.lease_task.done():
+            self.lease_task = asyncio.create_task(self.run_lease_keeper())
+
+    async def run_lease_keeper(self):
+        """Renew owned leases and take over games of failed workers."""
+        try:
+            await self.leases.listen(self.feed)
+        except Exception as e:
+            logger.error(f"Error listening for routed commands: {e}")
         while True:
-            async with self.lock:
-                self.update_game_state(game_id)
-            await asyncio.sleep(self.update_interval)
+            await asyncio.sleep(self.lease_ttl / 3)
+            # pub/sub may lose an announcement: drain once per renewal
+            self.leases.pending = True
+            try:
+                for game_id in await self.leases.renew_all():
+                    logger.warning(f"Lost lease on game {game_id}")
+                    self.drop_game(game_id)
+                for game_id in await self.leases.orphaned():
+                    await self.adopt_game(game_id)
+            except Exception as e:
+                logger.error(f"Error maintaining game leases: {e}")
+
+    async def adopt_game(self, game_id):
+        """Claim a game without a live owner and resume it from Redis."""
+        if self.leases is None or not await self.leases.claim(game_id):
+            return False
+        if self.in_memory:
+            game_state = await self.get_game_state(game_id)
+            if not game_state:
+                await self.leases.forget(game_id)
+                return False
+            # resume from the checkpoint without integrating the downtime
+            game_state['timestamp'] = self.clock()
+            self.store_game_state(game_id, game_state)
+        # the replay goes on from here, without what was recorded before
+        self.replays.setdefault(
+            game_id, ReplayRecorder(self.replay_keyframe_interval))
+        logger.info(f"Took over game {game_id}")
+        self.start_game_update_task(game_id)
+        return True
+
+    async def run_scheduler(self):
+        """Tick all active games on a fixed, drift-compensated deadline."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        # delayed spectator frames are still published after the last game
+        while self.active_games or self.spectator_backlog:
+            deadline += self.update_interval
+            started = loop.time()
+            try:
+                await self.tick_all()
+            except Exception:
+                # a failed tick (e.g. Redis unreachable) must not stop
+                # every game of the worker; the next one tries again
+                self.tick_errors += 1
+                logger.exception("Error ticking games")
+            now = loop.time()
+            self.tick_count += 1
+            self.last_tick_duration = now - started
+            if self.tick_count % round(self.stats_interval * self.tick_rate) == 0:
+                logger.info(f"Scheduler stats: {self.scheduler_stats()}")
+            if now > deadline:
+                lag = now - deadline
+                self.overruns += 1
+                self.max_lag = max(self.max_lag, lag)
+                # Frames we are too late for are dropped instead of bursted;
+                # the physics step is timestamp based so no time is lost.
+                missed = int(lag // self.update_interval)
+                if missed:
+                    self.skipped_frames += missed
+                    deadline += missed * self.update_interval
+            await asyncio.sleep(max(0, deadline - now))
+        self.scheduler_task = None
+
+    async def tick_all(self):
+        if not self.in_memory:
+            # COMMIT_TICK publishes the players' frames of this mode
+            send = self.tick_count % self.send_interval == 0
+            if self.tick_count % self.idle_tick_divisor:
+                frames = await self.tick_stored_games(list(self.awake_games), send)
+            else:
+                frames = await self.tick_stored_games(list(self.active_games), send)
+            await self.publish_frames(frames, players=False)
+            return
+        if self.leases is not None:
+            for command in await self.leases.drain():
+                self.apply_command(command)
+        self.apply_inputs()
+        if self.batch is not None:
+            ticked = self.tick_batch()
+        else:
+            ticked = list(self.awake_games)
+            for game_id in ticked:
+                try:
+                    self.update_game_state(game_id)
+                except Exception as e:
+                    logger.error(f"Error updating game {game_id}: {e}")
+        await self.flush_checkpoints()
+        game_ids = self.transitions
+        self.transitions = set()
+        game_ids.update(self.sending_games().intersection(ticked))
+        self.sync_games(game_ids)
+        await self.publish_frames([(game_id, self.games[game_id])
+                                   for game_id in game_ids if game_id in self.games])
+
+    async def publish_frames(self, frames, players=True):
+        """Publish each (game_id, game_state) frame once, in one pipeline.
+
+        Every frame goes to the players' channel; the spectator stream only
+        gets frames that are due (see spectator_interval) or change the
+        status, once they are spectator_delay old. Status and score changes
+        update the live games directory, and frames feed the replays being
+        recorded.
+        """
+        if not self.publish or not (frames or self.spectator_backlog):
+            return
+        now = self.clock()
+        server_time = time.monotonic()
+        tick = self.tick_count
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for game_id, game_state in frames:
+                    status = game_state['status']
+                    self.record_frame(pipe, game_id, game_state)
+                    data = encode_game_state(game_state, self.tick_count, server_time)
+                    if players:
+                        pipe.publish(self.feed.channel(game_id), data)
+                    self.live.update(pipe, game_id, game_state)
+                    due = (tick - self.send_phases.get(game_id, 0)) % self.spectator_interval == 0
+                    if due or status != self.spectated_status.get(game_id):
+                        self.spectated_status[game_id] = status
+                        self.spectator_backlog.append(
+                            (now + self.spectator_delay, game_id, data))
+                backlog = self.spectator_backlog
+                while backlog and backlog[0][0] <= now:
+                    _, game_id, data = backlog.popleft()
+                    pipe.publish(self.feed.channel(game_id, spectator=True), data)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error publishing game frames: {e}")
+
+    def record_frame(self, pipe, game_id, game_state):
+        recorder = self.replays.get(game_id)
+        if recorder is None:
+            return
+        recorder.frame(game_state)
+        if game_state['status'] in ('finished', 'forfeited'):
+            # stored before the final frame is published, for the players'
+            # consumers to save it with the match
+            del self.replays[game_id]
+            pipe.set(self.replay_key(game_id), recorder.finish(),
+                     ex=self.replay_ttl)
+            pipe.publish(self.replay_channel(game_id), b'')
+
+    @staticmethod
+    def replay_key(game_id):
+        return f"replay:{game_id}"
+
+    @staticmethod
+    def replay_channel(game_id):
+        return f"replay-stored:{game_id}"
+
+    async def get_replay(self, game_id):
+        return await self.client.get(self.replay_key(game_id))
+
+    async def wait_for_replay(self, game_id, timeout=None):
+        """Return the replay of an ended game, once the worker recording it
+        has stored it, or None if that takes more than timeout seconds
+        (replay_wait_timeout by default)."""
+        stored = asyncio.Event()
+
+        async def on_stored(frame):
+            stored.set()
+
+        channel = self.replay_channel(game_id)
+        await self.feed.subscribe_channel(channel, on_stored)
+        try:
+            # read after subscribing, so a replay stored in between is not
+            # missed
+            data = await self.get_replay(game_id)
+            if data is not None:
+                return data
+            try:
+                await asyncio.wait_for(
+                    stored.wait(), timeout or self.replay_wait_timeout)
+            except asyncio.TimeoutError:
+                return None
+            return await self.get_replay(game_id)
+        finally:
+            await self.feed.unsubscribe_channel(channel, on_stored)
+
+    async def tick_stored_games(self, game_ids, send=True):
+        """Tick games held in Redis with one read and one write pipeline,
+        and return the frames sent: all of them if send is set, otherwise
+        those whose status changed."""
+        async with self.client.pipeline(transaction=False) as pipe:
+            for game_id in game_ids:
+                pipe.get(game_id)
+            raws = await pipe.execute()
+        timestamp = self.clock()
+        server_time = time.monotonic()
+        stepped = []
+        async with self.client.pipeline(transaction=False) as pipe:
+            for game_id, raw in zip(game_ids, raws):
+                game_state = self.load_game_state(raw)
+                if not game_state or game_state['status'] == 'setup':
+                    continue
+                if self.is_idle(game_state):
+                    self.awake_games.discard(game_id)
+                    continue
+                self.awake_games.add(game_id)
+                status = game_state['status']
+                self.step_game_state(game_state, timestamp)
+                data = encode_game_state(game_state, self.tick_count, server_time)
+                await self.commit_tick_script(
+                    keys=[game_id], args=[raw, data, 1 if send else 0],
+                    client=pipe)
+                stepped.append((game_id, game_state,
+                                send or game_state['status'] != status))
+            committed = await pipe.execute()
+        # ticks that lost the race with an input were neither stored nor
+        # published
+        return [(game_id, game_state)
+                for (game_id, game_state, sent), ok in zip(stepped, committed)
+                if ok and sent]
+
+    def tick_batch(self):
+        """Step every awake game with BatchPhysics and return their ids.
+
+        Only the games that scored or are due for a frame get their state
+        dict written back and go through store_game_state, which counts
+        their ticks to the next checkpoint; the others stay in the arrays.
+        """
+        awake = list(self.awake_games)
+        goals = self.batch.step(self.clock())
+        sending = self.sending_games().intersection(self.awake_games)
+        scorers = dict(goals)
+        due = sending.union(scorers)
+        self.batch.write_back(self.games, due)
+        self.batch_stale = self.awake_games.difference(due)
+        for game_id in due:
+            game_state = self.games.get(game_id)
+            if game_state is None:
+                continue
+            scorer = scorers.get(game_id)
+            if scorer is not None:
+                self.goal_scored(game_state, scorer)
+            self.store_game_state(
+                game_id, game_state, transition=scorer is not None,
+                sync_batch=scorer is not None,
+                ticks=self.send_interval if game_id in sending else 0)
+            if self.is_idle(game_state):
+                self.sleep_game(game_id)
+        return awake
+
+    def sending_games(self):
+        """The in-memory games whose frame is due this tick."""
+        return self.send_groups[self.tick_count % self.send_interval]
+
+    def sync_games(self, game_ids):
+        """Write back the BatchPhysics state of the given games whose dict
+        lags it."""
+        stale = [game_id for game_id in game_ids if game_id in self.batch_stale]
+        if stale:
+            self.batch.write_back(self.games, stale)
+            self.batch_stale.difference_update(stale)
+
+    def is_idle(self, game_state):
+        if game_state['status'] in ('finished', 'forfeited'):
+            return True
+        return (game_state['status'] != 'running'
+                and not game_state['player1']['dx']
+                and not game_state['player2']['dx'])
+
+    def sleep_game(self, game_id):
+        self.awake_games.discard(game_id)
+        if self.batch is not None:
+            self.batch.set_active(game_id, False)
+        if self.ticks_since_checkpoint.get(game_id):
+            # make sure the state it fell asleep in reaches Redis
+            self.checkpoint(game_id)
+
+    def wake_game(self, game_id):
+        if game_id in self.awake_games:
+            return
+        self.awake_games.add(game_id)
+        game_state = self.games.get(game_id)
+        if game_state is not None:
+            # nothing moved while asleep, so do not integrate that time
+            game_state['timestamp'] = self.clock()
+            if self.batch is not None:
+                self.batch.load(game_id, game_state)
+
+    def scheduler_stats(self):
+        return {
+            'active_games': len(self.active_games),
+            'awake_games': len(self.awake_games),
+            'ticks': self.tick_count,
+            'overruns': self.overruns,
+            'skipped_frames': self.skipped_frames,
+            'max_lag': self.max_lag,
+            'last_tick_duration': self.last_tick_duration,
+            'tick_errors': self.tick_errors,
+        }
 
     def update_game_state(self, game_id):
-        game_state = self.get_game_state(game_id)
+        game_state = self.games.get(game_id)
         if not game_state or game_state['status'] == 'setup':
             return
 
-        timestamp = time.time()
+        status = game_state['status']
+        self.step_game_state(game_state, self.clock())
+        self.store_game_state(game_id, game_state,
+                              transition=game_state['status'] != status)
+        if self.is_idle(game_state):
+            self.sleep_game(game_id)
+
+    def step_game_state(self, game_state, timestamp):
+        """Advance game_state in place to timestamp."""
         timedelta = timestamp - game_state['timestamp']
-        timedelta *= self.target_fps
+        timedelta *= self.speed_scale
         game_state['timestamp'] = timestamp
 
         game_state['player1']['x'] += (game_state['player1']
@@ -89,8 +613,8 @@ class GameManager:
         game_state['player2']['x'] = max(-self.arena_height + self.paddle_len, min(
             self.arena_height - self.paddle_len, game_state['player2']['x']))
 
-        if game_state['status'] == 'running':
-            pass
+        start_x = game_state['ball']['x']
+        start_y = game_state['ball']['y']
         game_state['ball']['x'] += (game_state['ball']
                                     ['dx'] * game_state['ball']['v'] * timedelta)
         game_state['ball']['y'] += (game_state['ball']
@@ -106,44 +630,60 @@ class GameManager:
                                           min(self.arena_height, game_state['ball']['x']))
 
             # Paddle collisions
-            if (game_state['ball']['y'] <= -self.arena_width + (self.goal_line)
-                    and game_state['player1']['x'] - (self.paddle_len) <= game_state['ball']['x'] <= game_state['player1']['x'] + (self.paddle_len)):
-                ref_angle = (game_state['ball']['x'] - game_state['player1']
-                             ['x']) / (self.paddle_len) * (math.pi / 4)
-                game_state['ball']['dy'] = math.cos(ref_angle)
-                game_state['ball']['dx'] = math.sin(ref_angle)
-                self.normalize_direction(game_state['ball'])
-                game_state['ball']['v'] = min(
-                    game_state['ball']['v'] + 0.1, self.max_speed)
-                # print(f"Ball hit player1 paddle at x:{game_state['ball']['x']} y:{game_state['ball']['y']}. Player: {game_state['player1']['x']}")
-            if (game_state['ball']['y'] >= self.arena_width - (self.goal_line)
-                    and game_state['player2']['x'] - (self.paddle_len) <= game_state['ball']['x'] <= game_state['player2']['x'] + (self.paddle_len)):
-                ref_angle = (game_state['ball']['x'] - game_state['player2']
-                             ['x']) / (self.paddle_len) * (math.pi / 4)
-                game_state['ball']['dy'] = -math.cos(ref_angle)
-                game_state['ball']['dx'] = math.sin(ref_angle)
-                self.normalize_direction(game_state['ball'])
-                game_state['ball']['v'] = min(
-                    game_state['ball']['v'] + 0.1, self.max_speed)
-                # print(f"Ball hit player2 paddle at x:{game_state['ball']['x']} y:{game_state['ball']['y']}. Player: {game_state['player2']['x']}")
+            for player, line, side in (
+                    ('player1', -self.arena_width + self.goal_line, 1),
+                    ('player2', self.arena_width - self.goal_line, -1)):
+                self.paddle_collision(game_state['ball'], start_x, start_y,
+                                      game_state[player]['x'], line, side,
+                                      timedelta)
 
             # Goals
             if game_state['ball']['y'] >= self.arena_width + self.ball_size:
-                game_state['score']['p1'] += 1
-                self.prev_score = False
-                self.score_update(game_state)
+                self.goal_scored(game_state, 'p1')
             if game_state['ball']['y'] <= -self.arena_width - self.ball_size:
-                game_state['score']['p2'] += 1
-                self.prev_score = True
-                self.score_update(game_state)
+                self.goal_scored(game_state, 'p2')
 
-        self.set_game_state(game_id, game_state)
+    def paddle_collision(self, ball, start_x, start_y, paddle_x, line, side,
+                         timedelta):
+        """Bounce the ball off a paddle its path crossed during this step.
+
+        The segment from (start_x, start_y) to the ball's new position is
+        swept against the paddle line, so a fast ball or a late tick cannot
+        carry it through the paddle. side is 1 for player1's paddle and -1
+        for player2's.
+        """
+        if ball['dy'] * side >= 0 or (ball['y'] - line) * side > 0:
+            return
+        # fraction of the step at which the ball reached the paddle line,
+        # 0 if it was already behind it
+        t = 0
+        if (start_y - line) * side > 0:
+            t = (start_y - line) / (start_y - ball['y'])
+        x = start_x + (ball['x'] - start_x) * t
+        if not paddle_x - self.paddle_len <= x <= paddle_x + self.paddle_len:
+            return
+        y = start_y + (ball['y'] - start_y) * t
+        ref_angle = (x - paddle_x) / self.paddle_len * (math.pi / 4)
+        ball['dy'] = side * math.cos(ref_angle)
+        ball['dx'] = math.sin(ref_angle)
+        self.normalize_direction(ball)
+        ball['v'] = min(ball['v'] + 0.1, self.max_speed)
+        # the rest of the step is spent moving away from the paddle
+        rest = ball['v'] * timedelta * (1 - t)
+        ball['x'] = max(-self.arena_height,
+                        min(self.arena_height, x + ball['dx'] * rest))
+        ball['y'] = y + ball['dy'] * rest
 
     def normalize_direction(self, direction):
         magnitude = math.sqrt(direction['dx']**2 + direction['dy']**2)
         direction['dx'] /= magnitude
         direction['dy'] /= magnitude
 
+    def goal_scored(self, game_state, scorer):
+        game_state['score'][scorer] += 1
+        self.prev_score = scorer == 'p2'
+        self.score_update(game_state)
+
     def score_update(self, game_state):
         # logger.info(
             # f"Goal at x:{game_state['ball']['x']} y:{game_state['ball']['y']}")
@@ -159,19 +699,141 @@ class GameManager:
         else:
             game_state['status'] = 'paused'
 
-    async def update_player_state(self, game_id, player, direction):
-        game_state = self.get_game_state(game_id)
-        if player == 'player1':
-            game_state['player1']['dx'] = direction
-        elif player == 'player2':
-            game_state['player2']['dx'] = direction
-        else:
+    @staticmethod
+    def is_direction(direction):
+        """Whether direction is a paddle direction: -1, 0 or 1."""
+        # not a bool or a float either: directions are packed as integers
+        return type(direction) is int and direction in (-1, 0, 1)
+
+    async def update_player_state(self, game_id, player, direction, seq=None):
+        """Move a paddle; seq, if given, is the client's increasing input
+        number, acknowledged in the player's 'seq' once applied."""
+        if not self.is_direction(direction):
+            logger.debug(f"Invalid direction for {game_id}: {direction!r}")
+            return
+        if not self.in_memory:
+            if player in ('player1', 'player2'):
+                args = [PLAYER_CODES[player], direction, self.clock()]
+                if seq is not None:
+                    args.append(seq)
+                await self.set_player_dx_script(keys=[game_id], args=args)
+                self.awake_games.add(game_id)
+                if game_id in self.replays:
+                    self.replays[game_id].move(self.clock(), player, direction)
             return
-        async with self.lock:
-            self.set_game_state(game_id, game_state)
+        await self.dispatch_command(
+            {'game_id': game_id, 'op': 'move', 'player': player,
+             'direction': direction, 'seq': seq})
 
     async def set_player_ready(self, game_id, player):
-        game_state = self.get_game_state(game_id)
+        if not self.in_memory:
+            if player in ('player1', 'player2'):
+                await self.set_player_ready_script(keys=[game_id], args=[
+                    PLAYER_CODES[player], 1 if self.flip else -1,
+                    1 if self.prev_score else -1, self.ball_speed, self.clock()])
+                self.awake_games.add(game_id)
+                if game_id in self.replays:
+                    self.replays[game_id].ready(self.clock(), player)
+                await self.publish_stored_game(game_id)
+            return
+        await self.dispatch_command(
+            {'game_id': game_id, 'op': 'ready', 'player': player})
+
+    async def forfeit_game(self, game_id, forfeiting_player):
+        if not self.in_memory:
+            await self.forfeit_game_script(
+                keys=[game_id], args=[PLAYER_CODES.get(forfeiting_player, 0)])
+            await self.publish_stored_game(game_id)
+            return
+        await self.dispatch_command(
+            {'game_id': game_id, 'op': 'forfeit', 'player': forfeiting_player})
+
+    async def publish_stored_game(self, game_id):
+        # The scripts publish status changes to the players only; pass them
+        # on to the spectator stream, which publish_frames keeps in order.
+        game_state = await self.get_game_state(game_id)
+        if game_state is not None:
+            await self.publish_frames([(game_id, game_state)], players=False)
+
+    async def dispatch_command(self, command):
+        """Apply a command locally or forward it to the owning worker."""
+        game_id = command['game_id']
+        if game_id in self.games:
+            transition = self.apply_command(command)
+        elif self.leases is not None:
+            transition = False
+            if not await self.leases.route(game_id, command):
+                if await self.adopt_game(game_id):
+                    transition = self.apply_command(command)
+        else:
+            return
+        if transition:
+            # do not make clients wait for the next tick to see it
+            self.transitions.discard(game_id)
+            await self.publish_frames([(game_id, self.games[game_id])])
+
+    def apply_command(self, command):
+        """Apply a command to a game held by this worker and return whether
+        it changed the game status."""
+        game_id, player = command['game_id'], command['player']
+        game_state = self.games.get(game_id)
+        if not game_state:
+            return False
+        if command['op'] == 'move':
+            # routed commands come from other workers: check them again
+            if (player in ('player1', 'player2')
+                    and self.is_direction(command.get('direction'))):
+                self.pending_inputs.append(command)
+            return False
+        self.wake_game(game_id)
+        self.sync_games((game_id,))
+        status = game_state['status']
+        recorder = self.replays.get(game_id)
+        match command['op']:
+            case 'ready':
+                if recorder is not None and player in ('player1', 'player2'):
+                    recorder.ready(game_state['timestamp'], player)
+                self.ready_player(game_state, player)
+            case 'forfeit':
+                if game_state['status'] != 'finished':
+                    game_state['status'] = 'forfeited'
+                    game_state['forfeiting_player'] = player
+                status = None
+        transition = game_state['status'] != status
+        self.store_game_state(game_id, game_state, transition=transition)
+        return transition
+
+    def apply_inputs(self):
+        """Apply the moves queued since the last tick, in arrival order,
+        dropping the ones older than an input already applied."""
+        inputs, self.pending_inputs = self.pending_inputs, []
+        for command in inputs:
+            game_id, player = command['game_id'], command['player']
+            game_state = self.games.get(game_id)
+            if not game_state or not self.is_direction(command['direction']):
+                continue
+            seq = command.get('seq')
+            if seq is not None:
+                if seq <= game_state[player]['seq']:
+                    continue
+                game_state[player]['seq'] = seq
+            self.wake_game(game_id)
+            recorder = self.replays.get(game_id)
+            if self.batch is not None:
+                # only the paddle changes: no need to write the game back
+                if recorder is not None:
+                    recorder.move(self.batch.timestamp_of(game_id), player,
+                                  command['direction'])
+                game_state[player]['dx'] = command['direction']
+                self.batch.set_direction(game_id, player, command['direction'])
+                continue
+            if recorder is not None:
+                recorder.move(game_state['timestamp'], player,
+                              command['direction'])
+            game_state[player]['dx'] = command['direction']
+            self.store_game_state(game_id, game_state)
+
+    def ready_player(self, game_state, player):
         if player == 'player1':
             game_state['player1']['ready'] = True
         elif player == 'player2':
@@ -181,17 +843,6 @@ class GameManager:
             game_state['ball'] = {'x': 0, 'y': 0, 'dx': 1 if self.flip else -
                                   1, 'dy': 1 if self.prev_score else -1, 'v': self.ball_speed}
             game_state['status'] = 'running'
-            game_state['timestamp'] = time.time()
-        async with self.lock:
-            self.set_game_state(game_id, game_state)
-
-    async def forfeit_game(self, game_id, forfeiting_player):
-        game_state = self.get_game_state(game_id)
-        if game_state and game_state['status'] != 'finished':
-            game_state['status'] = 'forfeited'
-            game_state['forfeiting_player'] = forfeiting_player
-        async with self.lock:
-            self.set_game_state(game_id, game_state)
-
+            game_state['timestamp'] = self.clock()
 
 game_manager = GameManager()
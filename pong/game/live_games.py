@@ -0,0 +1,122 @@
+import json
+import time
+
+
+class LiveGames:
+    """Directory of the games being played, to list "live now" games.
+
+    games:live is a sorted set of game ids by start time and live:<game_id>
+    a hash holding the entry: players, score, status and viewer count. The
+    engine keeps status and score up to date from the frames it publishes,
+    consumers add player names and count viewers. Finished games are removed.
+
+    Every change is published as JSON on the live:changes channel (see
+    GameFeed) with the fields that changed, so clients can keep a listing up
+    to date without polling.
+    """
+
+    index_key = 'games:live'
+    changes_channel = 'live:changes'
+    # entries of games nobody cleared (e.g. a worker died) expire by themselves
+    entry_ttl = 3600
+
+    def __init__(self, client):
+        self.client = client
+        # (status, score p1, score p2) last written for each game
+        self.listed = {}
+
+    @staticmethod
+    def entry_key(game_id):
+        return f"live:{game_id}"
+
+    def change(self, pipe, game_id, **fields):
+        pipe.publish(self.changes_channel, json.dumps(
+            {'type': 'live_game', 'game_id': game_id, **fields}))
+
+    def update(self, pipe, game_id, game_state):
+        """Queue on pipe the directory update for a game frame, if the
+        listed fields changed."""
+        status = game_state['status']
+        score = game_state['score']
+        listed = (status, score['p1'], score['p2'])
+        previous = self.listed.get(game_id)
+        if previous == listed:
+            return
+        self.listed[game_id] = listed
+        if status in ('finished', 'forfeited'):
+            self.remove(pipe, game_id, status)
+            return
+        key = self.entry_key(game_id)
+        pipe.hset(key, mapping={
+            'game_id': game_id,
+            'status': status,
+            'score_p1': score['p1'],
+            'score_p2': score['p2'],
+        })
+        pipe.expire(key, self.entry_ttl)
+        if previous is None:
+            pipe.zadd(self.index_key, {game_id: time.time()}, nx=True)
+        self.change(pipe, game_id, status=status,
+                    score={'p1': score['p1'], 'p2': score['p2']})
+
+    def remove(self, pipe, game_id, status=None):
+        pipe.zrem(self.index_key, game_id)
+        pipe.delete(self.entry_key(game_id))
+        self.change(pipe, game_id, status=status, removed=True)
+
+    async def forget(self, game_id):
+        self.listed.pop(game_id, None)
+        async with self.client.pipeline(transaction=False) as pipe:
+            self.remove(pipe, game_id)
+            await pipe.execute()
+
+    async def add_player(self, game_id, player, username):
+        key = self.entry_key(game_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hset(key, player, username)
+            pipe.expire(key, self.entry_ttl)
+            self.change(pipe, game_id, **{player: username})
+            await pipe.execute()
+
+    async def add_viewer(self, game_id, count=1):
+        key = self.entry_key(game_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hincrby(key, 'viewers', count)
+            pipe.expire(key, self.entry_ttl)
+            viewers, _ = await pipe.execute()
+        async with self.client.pipeline(transaction=False) as pipe:
+            self.change(pipe, game_id, viewers=viewers)
+            await pipe.execute()
+
+    async def list(self, offset=0, limit=42):
+        """Return a page of entries, most recently started first, and the
+        number of live games."""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.index_key)
+            pipe.zrevrange(self.index_key, offset, offset + limit - 1)
+            count, game_ids = await pipe.execute()
+        async with self.client.pipeline(transaction=False) as pipe:
+            for game_id in game_ids:
+                pipe.hgetall(self.entry_key(game_id.decode()))
+            entries = await pipe.execute()
+        games, expired = [], []
+        for game_id, entry in zip(game_ids, entries):
+            if b'status' not in entry:
+                expired.append(game_id)
+                continue
+            games.append(self.load_entry(entry))
+        if expired:
+            await self.client.zrem(self.index_key, *expired)
+        return games, count - len(expired)
+
+    @staticmethod
+    def load_entry(entry):
+        entry = {key.decode(): value.decode() for key, value in entry.items()}
+        return {
+            'game_id': entry['game_id'],
+            'player1': entry.get('player1'),
+            'player2': entry.get('player2'),
+            'status': entry['status'],
+            'score': {'p1': int(entry['score_p1']), 'p2': int(entry['score_p2'])},
+            'viewers': int(entry.get('viewers', 0)),
+        }
@@ -0,0 +1,149 @@
+from .game_feed import CHANNEL_PREFIX
+from .state_codec import FORMAT_VERSION, LAYOUT, STATUS_CODES
+
+# Lua scripts mutating a binary game state (see state_codec) atomically
+# inside Redis. Each one decodes the state with the same struct layout,
+# touches only the affected fields and writes it back, so inputs cost a
+# single EVALSHA round trip and cannot interleave with a tick. Status
+# changes are published on the game's channel (see game_feed) at once.
+#
+# Field indices in the unpacked table:
+#   1 version, 2 status, 3-5 player1 x/dx/ready, 6-8 player2 x/dx/ready,
+#   9-13 ball x/y/dx/dy/v, 14-16 score p1/p2/limit, 17 timestamp,
+#   18 forfeiting player, 19-20 player1/player2 seq, 21 tick,
+#   22 server time
+
+_PRELUDE = f"""
+local fmt = '{LAYOUT.format}'
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return nil
+end
+local s = {{struct.unpack(fmt, raw)}}
+if s[1] ~= {FORMAT_VERSION} then
+    return redis.error_reply('unsupported game state format')
+end
+local status = s[2]
+local function save()
+    local packed = struct.pack(fmt, unpack(s, 1, 22))
+    redis.call('SET', KEYS[1], packed)
+    if s[2] ~= status then
+        redis.call('PUBLISH', '{CHANNEL_PREFIX}' .. KEYS[1], packed)
+    end
+end
+"""
+
+# ARGV: player (1|2), direction, timestamp, optional input seq; inputs with
+# a seq not above the last one applied are dropped
+SET_PLAYER_DX = _PRELUDE + f"""
+local seq = tonumber(ARGV[4])
+if seq then
+    if seq <= s[18 + tonumber(ARGV[1])] then
+        return s[2]
+    end
+    s[18 + tonumber(ARGV[1])] = seq
+end
+if s[2] ~= {STATUS_CODES['running']} and s[4] == 0 and s[7] == 0 then
+    -- the game was asleep, do not integrate the time nothing moved
+    s[17] = tonumber(ARGV[3])
+end
+local offset = (tonumber(ARGV[1]) - 1) * 3
+s[4 + offset] = tonumber(ARGV[2])
+save()
+return s[2]
+"""
+
+# ARGV: player (1|2), serve dx, serve dy, ball speed, timestamp
+SET_PLAYER_READY = _PRELUDE + f"""
+local offset = (tonumber(ARGV[1]) - 1) * 3
+s[5 + offset] = 1
+if s[5] == 1 and s[8] == 1 and s[2] ~= {STATUS_CODES['running']} then
+    s[9], s[10] = 0, 0
+    s[11], s[12] = tonumber(ARGV[2]), tonumber(ARGV[3])
+    s[13] = tonumber(ARGV[4])
+    s[17] = tonumber(ARGV[5])
+    s[2] = {STATUS_CODES['running']}
+end
+save()
+return s[2]
+"""
+
+# ARGV: forfeiting player (1|2)
+FORFEIT_GAME = _PRELUDE + f"""
+if s[2] ~= {STATUS_CODES['finished']} then
+    s[2] = {STATUS_CODES['forfeited']}
+    s[18] = tonumber(ARGV[1])
+end
+save()
+return s[2]
+"""
+
+# Compare-and-set used by the tick: ARGV[1] is the state the tick started
+# from, ARGV[2] the stepped state, which is also published if ARGV[3] is 1
+# (a send tick) or the status changed. If an input landed in between, the
+# tick is dropped and the next one steps from the newer state.
+COMMIT_TICK = f"""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2])
+if ARGV[3] == '1' or string.byte(ARGV[1], 2) ~= string.byte(ARGV[2], 2) then
+    redis.call('PUBLISH', '{CHANNEL_PREFIX}' .. KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Game ownership leases (see sharding.GameLeases). KEYS[1] is the lease key,
+# KEYS[2] the sorted set of lease expiries used to find orphaned games.
+_LEASE_EXPIRY = """
+local t = redis.call('TIME')
+local expiry = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000) + tonumber(ARGV[2])
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+redis.call('ZADD', KEYS[2], expiry, ARGV[3])
+return 1
+"""
+
+# ARGV: worker id, ttl in ms, game id
+CLAIM_LEASE = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+""" + _LEASE_EXPIRY
+
+# ARGV: worker id, ttl in ms, game id
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+""" + _LEASE_EXPIRY
+
+# ARGV: worker id, game id
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Games whose lease expired. KEYS[1] sorted set, ARGV[1] max count.
+ORPHANED_GAMES = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+return redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, ARGV[1])
+"""
+
+# Forward a command to the worker owning a game, and tell it on the channel
+# named after its queue. KEYS[1] lease key, ARGV[1] command queue prefix,
+# ARGV[2] payload.
+ROUTE_COMMAND = """
+local owner = redis.call('GET', KEYS[1])
+if not owner then
+    return 0
+end
+redis.call('RPUSH', ARGV[1] .. owner, ARGV[2])
+redis.call('PUBLISH', ARGV[1] .. owner, '')
+return 1
+"""
@@ -0,0 +1,159 @@
+import math
+import struct
+import zlib
+
+from .state_codec import (
+    LAYOUT, encode_game_state, decode_game_state, PLAYERS, PLAYER_CODES)
+
+# A replay is a zlib compressed stream of records, each one a kind and the
+# time since the start of the game in TIME_UNIT (fine enough to replay the
+# inputs on the engine's ticks):
+#
+#   keyframe  a state_codec encoded game state
+#   move      player, direction, as given to update_player_state
+#   ready     player, as given to set_player_ready
+#
+# Keyframes are taken on every status change (serves, goals, the end of the
+# game) and every keyframe_interval seconds; in between, the game is
+# re-simulated from the inputs. A match takes a few KB. The header holds the
+# format version and the start timestamp, keyframes keep their exact one.
+REPLAY_VERSION = 1
+HEADER = struct.Struct('<Bd')
+RECORD = struct.Struct('<BI')
+MOVE = struct.Struct('<Bf')
+READY = struct.Struct('<B')
+TIME_UNIT = 1e-4
+
+KEYFRAME, MOVE_INPUT, READY_INPUT = range(3)
+
+
+class ReplayRecorder:
+    """Records the replay of one game, fed by the engine ticking it."""
+
+    def __init__(self, keyframe_interval=5.0):
+        self.keyframe_interval = keyframe_interval
+        self.records = bytearray()
+        self.start = None
+        self.last_keyframe = None
+        self.status = None
+
+    def offset(self, timestamp):
+        if self.start is None:
+            self.start = timestamp
+        # rounded up, so an input never lands before the tick it follows
+        return max(0, math.ceil((timestamp - self.start) / TIME_UNIT))
+
+    def frame(self, game_state):
+        """Keyframe the state if its status changed or the last keyframe is
+        keyframe_interval old."""
+        timestamp = game_state['timestamp']
+        if (game_state['status'] == self.status
+                and timestamp - self.last_keyframe < self.keyframe_interval):
+            return
+        self.status = game_state['status']
+        self.last_keyframe = timestamp
+        self.records += RECORD.pack(KEYFRAME, self.offset(timestamp))
+        self.records += encode_game_state(game_state)
+
+    def move(self, timestamp, player, direction):
+        if self.start is None:
+            return
+        self.records += RECORD.pack(MOVE_INPUT, self.offset(timestamp))
+        self.records += MOVE.pack(PLAYER_CODES[player], direction)
+
+    def ready(self, timestamp, player):
+        if self.start is None:
+            return
+        self.records += RECORD.pack(READY_INPUT, self.offset(timestamp))
+        self.records += READY.pack(PLAYER_CODES[player])
+
+    def finish(self):
+        header = HEADER.pack(REPLAY_VERSION, self.start or 0.0)
+        return zlib.compress(header + self.records, 9)
+
+
+def load_replay(data):
+    """Return the records of a replay as (seconds, kind, payload) tuples,
+    with keyframe timestamps relative to the start too."""
+    data = zlib.decompress(data)
+    if not data or data[0] != REPLAY_VERSION:
+        raise ValueError("Unsupported replay format")
+    _, start = HEADER.unpack_from(data)
+    records = []
+    offset = HEADER.size
+    while offset < len(data):
+        kind, time = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if kind == KEYFRAME:
+            payload = decode_game_state(data[offset:offset + LAYOUT.size])
+            payload['timestamp'] -= start
+            offset += LAYOUT.size
+        elif kind == MOVE_INPUT:
+            player, direction = MOVE.unpack_from(data, offset)
+            payload = (PLAYERS[player], direction)
+            offset += MOVE.size
+        elif kind == READY_INPUT:
+            payload = PLAYERS[READY.unpack_from(data, offset)[0]]
+            offset += READY.size
+        else:
+            raise ValueError(f"Unknown replay record {kind}")
+        records.append((time * TIME_UNIT, kind, payload))
+    return records
+
+
+class ReplayPlayer:
+    """Re-simulates a replay with the physics of engine (a GameManager).
+
+    advance() moves the replay forward by some seconds of game time and
+    returns the state at that point, so playback speed is only a matter of
+    how much game time each sent frame covers. Waits while the ball is not
+    in play (players pressing ready) are cut to max_pause seconds.
+    """
+
+    def __init__(self, data, engine, max_pause=1.0):
+        self.records = load_replay(data)
+        self.engine = engine
+        self.max_pause = max_pause
+        self.index = 0
+        self.time = 0.0
+        self.state = None
+
+    @property
+    def done(self):
+        return self.index >= len(self.records)
+
+    def advance(self, seconds):
+        records = self.records
+        self.time += seconds
+        if (self.state is not None and self.state['status'] != 'running'
+                and not self.done):
+            self.time = max(self.time, records[self.index][0] - self.max_pause)
+        while not self.done and records[self.index][0] <= self.time:
+            time, kind, payload = records[self.index]
+            self.index += 1
+            if kind == KEYFRAME:
+                self.state = payload
+                continue
+            if self.state is None:
+                continue
+            # inputs are stamped with the tick they were applied after,
+            # which the state has already been stepped to
+            if time - self.state['timestamp'] > 2 * TIME_UNIT:
+                self.step(time)
+            if kind == MOVE_INPUT:
+                player, direction = payload
+                self.state[player]['dx'] = direction
+            else:
+                self.state[payload]['ready'] = True
+        if self.state is not None:
+            self.step(self.time)
+        return self.state
+
+    def step(self, time):
+        # no longer steps than the engine's ticks, whatever the playback
+        # rate, so bounces happen where they did
+        interval = self.engine.update_interval
+        while time - self.state['timestamp'] > 1.5 * interval:
+            self.engine.step_game_state(
+                self.state, self.state['timestamp'] + interval)
+        self.engine.step_game_state(self.state, time)
@@ -4,5 +4,7 @@ from . import consumers
 websocket_urlpatterns = [
     path('ws/game/<str:challenger>/', consumers.PongGameConsumer.as_asgi()),
     path('ws/tournament/<int:tournament_id>/', consumers.PongTournamentConsumer.as_asgi()),
+    path('ws/live/', consumers.LiveGamesConsumer.as_asgi()),
+    path('ws/replay/<int:match_id>/', consumers.ReplayConsumer.as_asgi()),
 	path("ws/online4P/<str:challenger>/", consumers.handle4PGame.as_asgi())
 ]
@@ -0,0 +1,119 @@
+import os
+import json
+import uuid
+import socket
+import logging
+
+from . import redis_scripts
+
+logger = logging.getLogger(__name__)
+
+
+class GameLeases:
+    """Renewable Redis leases deciding which worker ticks a game.
+
+    A worker owns a game while it holds lease:<game_id>. Expiries are
+    mirrored in a sorted set so any worker can cheaply find games whose
+    owner stopped renewing and take them over. Commands for a game owned by
+    another worker are pushed onto that worker's queue and announced on the
+    channel of the same name, and drained by it on its next tick.
+    """
+
+    expiries_key = 'games:leases'
+    commands_prefix = 'commands:'
+
+    def __init__(self, client, worker_id=None, ttl=5.0):
+        self.client = client
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+        self.ttl_ms = int(ttl * 1000)
+        self.owned = set()
+        # whether commands may be queued: once listening, drain only reads
+        # the queue after a command was announced (or pending is set)
+        self.pending = True
+        self.listening = False
+
+        self.claim_script = client.register_script(redis_scripts.CLAIM_LEASE)
+        self.renew_script = client.register_script(redis_scripts.RENEW_LEASE)
+        self.release_script = client.register_script(
+            redis_scripts.RELEASE_LEASE)
+        self.orphaned_script = client.register_script(
+            redis_scripts.ORPHANED_GAMES)
+        self.route_script = client.register_script(
+            redis_scripts.ROUTE_COMMAND)
+
+    @staticmethod
+    def lease_key(game_id):
+        return f"lease:{game_id}"
+
+    @property
+    def commands_key(self):
+        return f"{self.commands_prefix}{self.worker_id}"
+
+    async def claim(self, game_id):
+        claimed = await self.claim_script(
+            keys=[self.lease_key(game_id), self.expiries_key],
+            args=[self.worker_id, self.ttl_ms, game_id])
+        if claimed:
+            self.owned.add(game_id)
+        return bool(claimed)
+
+    async def renew_all(self):
+        """Renew every owned lease and return the games that were lost."""
+        if not self.owned:
+            return set()
+        game_ids = list(self.owned)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for game_id in game_ids:
+                await self.renew_script(
+                    keys=[self.lease_key(game_id), self.expiries_key],
+                    args=[self.worker_id, self.ttl_ms, game_id], client=pipe)
+            results = await pipe.execute()
+        lost = {game_id for game_id, renewed in zip(game_ids, results)
+                if not renewed}
+        self.owned -= lost
+        return lost
+
+    async def release(self, game_id):
+        self.owned.discard(game_id)
+        await self.release_script(
+            keys=[self.lease_key(game_id), self.expiries_key],
+            args=[self.worker_id, game_id])
+
+    async def forget(self, game_id):
+        """Drop a finished game from the lease registry, whoever owns it."""
+        self.owned.discard(game_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.delete(self.lease_key(game_id))
+            pipe.zrem(self.expiries_key, game_id)
+            await pipe.execute()
+
+    async def orphaned(self, limit=64):
+        game_ids = await self.orphaned_script(
+            keys=[self.expiries_key], args=[limit])
+        return [game_id.decode() for game_id in game_ids]
+
+    async def route(self, game_id, command):
+        routed = await self.route_script(
+            keys=[self.lease_key(game_id)],
+            args=[self.commands_prefix, json.dumps(command)])
+        return bool(routed)
+
+    async def listen(self, feed):
+        """Follow the commands routed to this worker through a GameFeed."""
+        await feed.subscribe_channel(self.commands_key, self.command_routed)
+        self.listening = True
+
+    async def command_routed(self, frame):
+        self.pending = True
+
+    async def drain(self):
+        if self.listening and not self.pending:
+            return []
+        # cleared first: a command announced meanwhile is drained next time
+        self.pending = False
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrange(self.commands_key, 0, -1)
+            pipe.delete(self.commands_key)
+            commands, _ = await pipe.execute()
+        return [json.loads(command) for command in commands]
@@ -0,0 +1,62 @@
+import struct
+
+# Fixed-layout binary encoding of a 2-player game state, used for Redis
+# storage and WebSocket bytes frames. The first byte is always the format
+# version so readers can reject layouts they do not understand.
+#
+#   version, status,
+#   player1 x, dx, ready, player2 x, dx, ready,
+#   ball x, y, dx, dy, v,
+#   score p1, p2, limit, timestamp, forfeiting player,
+#   player1 seq, player2 seq (last input applied, see update_player_state),
+#   tick, server time (frame of the engine tick that sent it, and the
+#   monotonic clock of its worker then, for clients to interpolate)
+FORMAT_VERSION = 3
+LAYOUT = struct.Struct('<BBffBffBfffffBBBdBIIId')
+
+STATUSES = ('setup', 'starting', 'running', 'paused', 'finished', 'forfeited')
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+PLAYERS = (None, 'player1', 'player2')
+PLAYER_CODES = {player: code for code, player in enumerate(PLAYERS)}
+
+
+def encode_game_state(game_state, tick=0, server_time=0.0):
+    player1 = game_state['player1']
+    player2 = game_state['player2']
+    ball = game_state['ball']
+    score = game_state['score']
+    return LAYOUT.pack(
+        FORMAT_VERSION,
+        STATUS_CODES[game_state['status']],
+        player1['x'], player1['dx'], player1['ready'],
+        player2['x'], player2['dx'], player2['ready'],
+        ball['x'], ball['y'], ball['dx'], ball['dy'], ball['v'],
+        score['p1'], score['p2'], score['limit'],
+        game_state['timestamp'],
+        PLAYER_CODES.get(game_state.get('forfeiting_player'), 0),
+        player1['seq'], player2['seq'],
+        tick, server_time,
+    )
+
+
+def decode_game_state(data):
+    if not data or data[0] != FORMAT_VERSION:
+        raise ValueError("Unsupported game state format")
+    (_, status,
+     p1_x, p1_dx, p1_ready, p2_x, p2_dx, p2_ready,
+     ball_x, ball_y, ball_dx, ball_dy, ball_v,
+     score_p1, score_p2, limit, timestamp, forfeiting,
+     p1_seq, p2_seq, tick, server_time) = LAYOUT.unpack(data)
+    game_state = {
+        'status': STATUSES[status],
+        'player1': {'x': p1_x, 'dx': p1_dx, 'ready': bool(p1_ready), 'seq': p1_seq},
+        'player2': {'x': p2_x, 'dx': p2_dx, 'ready': bool(p2_ready), 'seq': p2_seq},
+        'ball': {'x': ball_x, 'y': ball_y, 'dx': ball_dx, 'dy': ball_dy, 'v': ball_v},
+        'score': {'p1': score_p1, 'p2': score_p2, 'limit': limit},
+        'timestamp': timestamp,
+        'tick': tick,
+        'server_time': server_time,
+    }
+    if forfeiting:
+        game_state['forfeiting_player'] = PLAYERS[forfeiting]
+    return game_state
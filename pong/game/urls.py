@@ -1,12 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import MatchViewSet, PlayerViewSet, PlayerMatchViewSet, TournamentViewSet
+from .views import MatchViewSet, PlayerViewSet, PlayerMatchViewSet, TournamentViewSet, LiveGameViewSet
 
 router = DefaultRouter()
 router.register(r'matches', MatchViewSet)
 router.register(r'players', PlayerViewSet)
 router.register(r'player_matches', PlayerMatchViewSet)
 router.register(r'tournaments', TournamentViewSet)
+router.register(r'live', LiveGameViewSet, basename='live')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,7 +1,9 @@
 from django.contrib.auth.models import User
 from django.shortcuts import render
 from django.template import loader
+from asgiref.sync import async_to_sync
 from rest_framework import viewsets, status
+from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
@@ -9,6 +11,7 @@ from rest_framework.permissions import IsAuthenticated
 from api.models import Match, Profile, PlayerMatch, Tournament, TournamentPlayer
 from .serializers import MatchSerializer, PlayerSerializer, PlayerMatchSerializer, TournamentPlayerSerializer, TournamentSerializer
 from .forms import CreateTournamentForm
+from .game_manager import game_manager
 
 import logging
 
@@ -196,3 +199,22 @@ class TournamentViewSet(viewsets.ModelViewSet):
         """Get the current round of a tournament."""
         tournament = self.get_object()
         return Response({'current_round': tournament.current_round}, status=status.HTTP_200_OK)
+
+
+class LiveGameViewSet(viewsets.ViewSet):
+    """API endpoint for the games being played, most recently started first."""
+    permission_classes = [IsAuthenticated]
+
+    def list(self, request):
+        """List live games with their players, score, status and viewers."""
+        paginator = LimitOffsetPagination()
+        paginator.request = request
+        paginator.limit = paginator.get_limit(request)
+        paginator.offset = paginator.get_offset(request)
+        try:
+            games, paginator.count = async_to_sync(game_manager.live.list)(
+                paginator.offset, paginator.limit)
+        except Exception as e:
+            logger.error(f"Error listing live games: {e}")
+            return Response({'message': 'live games unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return paginator.get_paginated_response(games)
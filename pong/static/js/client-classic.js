@@ -712,11 +712,13 @@ class ClientClassic {
 		const ratio = (this.arena.height + this.arena.width) / (ARENA_HEIGHT * 2 + ARENA_WIDTH * 2);
 		const left = this.isChallenger ? this.player1 : this.player2;
 		const right = this.isChallenger ? this.player2 : this.player1;
-		[ , left.y] = this.transposePosition(-this.gameData.player1.x * ratio, 0);
-		[ , right.y] = this.transposePosition(-this.gameData.player2.x * ratio, 0);
-		[this.ball.x, this.ball.y] = this.transposePosition(-this.gameData.ball.x * ratio, this.gameData.ball.y * ratio);
-		this.ball.vx = this.gameData.ball.dx;
-		this.ball.vy = this.gameData.ball.dy;
+		// frames come at the send rate: draw between the last two of them
+		const frame = this.gameData.interpolated();
+		[ , left.y] = this.transposePosition(-frame.player1 * ratio, 0);
+		[ , right.y] = this.transposePosition(-frame.player2 * ratio, 0);
+		[this.ball.x, this.ball.y] = this.transposePosition(-frame.ball.x * ratio, frame.ball.y * ratio);
+		this.ball.vx = frame.ball.dx;
+		this.ball.vy = frame.ball.dy;
 		// detect paddle collision to hook audio visual effect
 		if (this.ball.x - this.ball.radius <= left.x + left.width) {
 			if (this.ball.y + this.ball.radius >= left.y - left.len / 2
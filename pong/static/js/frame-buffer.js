@@ -0,0 +1,60 @@
+"use strict";
+
+// Frames arrive at the send rate (20 Hz), slower than the game ticks: they
+// are drawn this many seconds in the past, between the two frames around
+// that time.
+const INTERPOLATION_DELAY = 0.1;
+const BUFFERED_FRAMES = 4;
+
+// The last frames of a game by server time, each a flat object of the
+// positions to interpolate.
+class FrameBuffer {
+	constructor () {
+		this.frames = [];
+		this.clockOffset = Infinity;
+	}
+
+	// A reset ball or a new status starts from its own frame, not a blend.
+	clear () {
+		this.frames = [];
+	}
+
+	push (serverTime, positions) {
+		// serverTime is the server's monotonic clock: the smallest offset
+		// seen is the one of the fastest delivered frame
+		this.clockOffset = Math.min(this.clockOffset, performance.now() / 1000 - serverTime);
+		this.frames.push({ time: serverTime, positions: positions });
+		if (this.frames.length > BUFFERED_FRAMES) {
+			this.frames.shift();
+		}
+	}
+
+	// The positions INTERPOLATION_DELAY seconds ago, between the frames
+	// around that time, or null when the latest frame is due.
+	interpolated () {
+		const frames = this.frames;
+		if (frames.length < 2) {
+			return null;
+		}
+		const time = performance.now() / 1000 - this.clockOffset - INTERPOLATION_DELAY;
+		if (time >= frames[frames.length - 1].time) {
+			return null;
+		}
+		if (time <= frames[0].time) {
+			return frames[0].positions;
+		}
+		let i = frames.length - 1;
+		while (frames[i - 1].time > time) {
+			i--;
+		}
+		const from = frames[i - 1], to = frames[i];
+		const t = (time - from.time) / (to.time - from.time);
+		const positions = {};
+		for (const key in to.positions) {
+			positions[key] = from.positions[key] + (to.positions[key] - from.positions[key]) * t;
+		}
+		return positions;
+	}
+};
+
+export { FrameBuffer };
@@ -5,6 +5,7 @@ import { getJSON, postJSON, getCookie } from "./utils.js";
 import { ClientClassic } from "./client-classic.js";
 import { Client3DGame } from "./pong3d.js";
 import { Game4P } from './pong4P.js';
+import { FrameBuffer } from "./frame-buffer.js";
 
 class GameSetup {
 	constructor (parentElement, player1, player2, isChallenger, mode="single", client="2d") {
@@ -29,6 +30,11 @@ class Player {
 	}
 };
 
+// Binary game_state frame layout, mirrors game/state_codec.py
+const STATE_FORMAT_VERSION = 3;
+const STATE_STATUSES = ["setup", "starting", "running", "paused", "finished", "forfeited"];
+const STATE_PLAYERS = [null, "player1", "player2"];
+
 class GameData {
 	constructor () {
 		this.status = "setup";
@@ -37,15 +43,73 @@ class GameData {
 		this.ball = { x: 0, y: 0, dx: 0, dy: 0, v: 2 };
 		this.score = { p1: 0, p2: 0, limit: 11 };
 		this.timestamp = Date.now();
+		this.frames = new FrameBuffer();
 	}
 
 	update (data) {
+		this.bufferFrame(data);
 		this.status = data.status;
 		this.player1 = data.player1;
 		this.player2 = data.player2;
 		this.ball = data.ball;
 		this.score = data.score;
 		this.timestamp = data.timestamp;
+		this.forfeiting_player = data.forfeiting_player;
+		this.tick = data.tick;
+		this.server_time = data.server_time;
+	}
+
+	bufferFrame (data) {
+		if (data.server_time === undefined || data.status !== this.status
+		|| data.score.p1 !== this.score.p1 || data.score.p2 !== this.score.p2) {
+			this.frames.clear();
+		}
+		if (data.server_time !== undefined) {
+			this.frames.push(data.server_time, {
+				player1: data.player1.x,
+				player2: data.player2.x,
+				ball_x: data.ball.x,
+				ball_y: data.ball.y,
+			});
+		}
+	}
+
+	// The paddles and ball as drawn now (see FrameBuffer.interpolated).
+	interpolated () {
+		const positions = this.frames.interpolated();
+		if (positions === null) {
+			return { player1: this.player1.x, player2: this.player2.x, ball: this.ball };
+		}
+		return {
+			player1: positions.player1,
+			player2: positions.player2,
+			ball: { ...this.ball, x: positions.ball_x, y: positions.ball_y },
+		};
+	}
+
+	updateFromBuffer (buffer) {
+		const view = new DataView(buffer);
+		if (view.getUint8(0) !== STATE_FORMAT_VERSION) {
+			console.error("Unsupported game state format", view.getUint8(0));
+			return;
+		}
+		this.update({
+			status: STATE_STATUSES[view.getUint8(1)],
+			player1: { x: view.getFloat32(2, true), dx: view.getFloat32(6, true), ready: view.getUint8(10) !== 0, seq: view.getUint32(52, true) },
+			player2: { x: view.getFloat32(11, true), dx: view.getFloat32(15, true), ready: view.getUint8(19) !== 0, seq: view.getUint32(56, true) },
+			ball: {
+				x: view.getFloat32(20, true),
+				y: view.getFloat32(24, true),
+				dx: view.getFloat32(28, true),
+				dy: view.getFloat32(32, true),
+				v: view.getFloat32(36, true),
+			},
+			score: { p1: view.getUint8(40), p2: view.getUint8(41), limit: view.getUint8(42) },
+			timestamp: view.getFloat64(43, true),
+			forfeiting_player: STATE_PLAYERS[view.getUint8(51)] ?? undefined,
+			tick: view.getUint32(60, true),
+			server_time: view.getFloat64(64, true),
+		});
 	}
 };
 
@@ -70,8 +134,9 @@ class GameRouter {
 		this.gameData = new GameData();
 
 		this.gameSocket = new WebSocket(
-			`wss://${window.location.host}/ws/game/${gameID}/?token=${accessToken}`
+			`wss://${window.location.host}/ws/game/${gameID}/?token=${accessToken}&encoding=binary`
 		);
+		this.gameSocket.binaryType = "arraybuffer";
 		console.log("Game socket created");
 
 		this.gameSocket.addEventListener('open', () => console.log("Game socket opened"));
@@ -90,6 +155,10 @@ class GameRouter {
 	}
 
 	async parseMessage (event) {
+		if (event.data instanceof ArrayBuffer) {
+			this.gameData.updateFromBuffer(event.data);
+			return;
+		}
 		const data = JSON.parse(event.data);
 
 		if (!data.hasOwnProperty('type')) {
@@ -1,5 +1,6 @@
 import { Online4P } from './online4P.js';
 import { showNotification } from './notification.js';
+import { FrameBuffer } from './frame-buffer.js';
 
 class Player {
 	constructor(used_paddles, my_paddle) {
@@ -22,6 +23,106 @@ class GameData {
 		this.bottom = {x: NaN, y: NaN };
 		this.animation_time = {first: 0, second: 0, third: 0}
 		this.disconnected = false;
+		this.frames = new FrameBuffer();
+	}
+
+	bufferFrame(data) {
+		// a goal resets the ball: do not blend across it
+		const restarted = data.loop < this.loop;
+		this.loop = data.loop;
+		if (data.goal || restarted) {
+			this.frames.clear();
+			return;
+		}
+		const positions = {};
+		for (const key of INTERPOLATED) {
+			positions[`${key}_x`] = data[`${key}_x`];
+			positions[`${key}_y`] = data[`${key}_y`];
+		}
+		this.frames.push(data.server_time, positions);
+	}
+
+	// The ball and paddles as drawn now (see FrameBuffer.interpolated).
+	interpolated() {
+		const positions = this.frames.interpolated();
+		if (positions === null || this.goal) {
+			return this;
+		}
+		const interpolated = {};
+		for (const key of INTERPOLATED) {
+			interpolated[key] = {x: positions[`${key}_x`], y: positions[`${key}_y`]};
+		}
+		return interpolated;
+	}
+}
+
+// the ball and paddles, drawn between frames (see FrameBuffer)
+const INTERPOLATED = ["ball", "left", "right", "top", "bottom"];
+
+// Binary update_game_data frames, see game/four_player_codec.py: a header
+// (version, kind, loop, server time, field mask) then the fields of the mask.
+// Deltas only carry the fields that changed since the last keyframe.
+const FRAME_FORMAT_VERSION = 2;
+const FRAME_KEYFRAME = 0;
+const FRAME_DELTA = 1;
+const FRAME_HEADER_SIZE = 18;
+const FRAME_FIELDS = [
+	["goal", "bool"], ["last_touch", "u8"], ["conceded", "u8"],
+	["score_left", "i16"], ["score_right", "i16"], ["score_top", "i16"], ["score_bottom", "i16"],
+	["old_score_left", "i16"], ["old_score_right", "i16"], ["old_score_top", "i16"], ["old_score_bottom", "i16"],
+	["animation_time_first", "f64"], ["animation_time_second", "f64"], ["animation_time_third", "f64"],
+	["ball_x", "f32"], ["ball_y", "f32"], ["ball_vx", "f32"], ["ball_vy", "f32"], ["speedx", "f32"], ["speedy", "f32"],
+	["left_x", "f32"], ["left_y", "f32"], ["right_x", "f32"], ["right_y", "f32"],
+	["top_x", "f32"], ["top_y", "f32"], ["bottom_x", "f32"], ["bottom_y", "f32"],
+	["serve_loop", "u32"], ["rng", "u32"],
+];
+const FRAME_TOUCHES = ["", "none", "left", "right", "top", "bottom"];
+const FRAME_CONCEDED_SIDES = ["left", "right", "top", "bottom"];
+
+class FrameDecoder {
+	constructor() {
+		this.keyframe = null;
+	}
+	decode(buffer) {
+		const view = new DataView(buffer);
+		if (view.getUint8(0) !== FRAME_FORMAT_VERSION) {
+			console.error("Unsupported 4-player frame format", view.getUint8(0));
+			return null;
+		}
+		const kind = view.getUint8(1);
+		// lockstep inputs frames are only sent to rooms opened in that mode
+		if (kind !== FRAME_KEYFRAME && kind !== FRAME_DELTA)
+			return null;
+		if (kind === FRAME_DELTA && this.keyframe === null)
+			return null;
+		const mask = view.getUint32(14, true);
+		const values = {};
+		let offset = FRAME_HEADER_SIZE;
+		FRAME_FIELDS.forEach(([name, type], index) => {
+			if (!(mask & (1 << index)))
+				return;
+			switch (type) {
+				case "bool": values[name] = view.getUint8(offset) !== 0; offset += 1; break;
+				case "u8": values[name] = view.getUint8(offset); offset += 1; break;
+				case "i16": values[name] = view.getInt16(offset, true); offset += 2; break;
+				case "u32": values[name] = view.getUint32(offset, true); offset += 4; break;
+				case "f32": values[name] = view.getFloat32(offset, true); offset += 4; break;
+				case "f64": values[name] = view.getFloat64(offset, true); offset += 8; break;
+			}
+		});
+		let data;
+		if (kind === FRAME_KEYFRAME) {
+			this.keyframe = values;
+			data = { ...values };
+		}
+		else
+			data = { ...this.keyframe, ...values };
+		data.type = "update_game_data";
+		data.loop = view.getUint32(2, true);
+		data.server_time = view.getFloat64(6, true);
+		data.last_touch = FRAME_TOUCHES[data.last_touch];
+		data.conceded = FRAME_CONCEDED_SIDES.filter((side, bit) => data.conceded & (1 << bit)).join("");
+		return data;
 	}
 }
 
@@ -37,9 +138,11 @@ class GameRouter4P {
 	}
 	initSocket(challenger, username) {
 		const accessToken = sessionStorage.getItem('access_token') || '';
-		const url = `wss://${window.location.host}/ws/online4P/${challenger}/?token=${accessToken}`;
+		const url = `wss://${window.location.host}/ws/online4P/${challenger}/?token=${accessToken}&encoding=binary`;
 		this.gameData = new GameData();
+		this.frameDecoder = new FrameDecoder();
 		this.chat_websocket = new WebSocket(url);
+		this.chat_websocket.binaryType = "arraybuffer";
 		this.username = username;
 
 		this.waitForConnection().then(() => {
@@ -55,6 +158,12 @@ class GameRouter4P {
 
 		this.chat_websocket.onmessage = (event) => {
 
+			if (event.data instanceof ArrayBuffer) {
+				const frame = this.frameDecoder.decode(event.data);
+				if (frame)
+					this.updateGameData(frame);
+				return;
+			}
 			const data = JSON.parse(event.data);
 			const type = data.type;
 
@@ -63,6 +172,12 @@ class GameRouter4P {
 				this.disconnected = true;
 				this.stopGame();
 			}
+			else if (type == "room_mode_mismatch") {
+				// this client does not run the lockstep simulation
+				this.notifyError(data.lockstep
+					? "This game is reserved for lockstep clients"
+					: "This game does not run in lockstep mode");
+			}
 			else if (type == "launch_game" && this.is_active == false) {
 				this.launchGame();
 			}
@@ -126,6 +241,7 @@ class GameRouter4P {
 		this.gameData.animation_time["first"] = data.animation_time_first;
 		this.gameData.animation_time["second"] = data.animation_time_second;
 		this.gameData.animation_time["third"] = data.animation_time_third;
+		this.gameData.bufferFrame(data);
 	}
 
 	waitForConnection() {
@@ -565,17 +565,19 @@ class Online4P {
 		this.playerTop.init (this.arena._width, this.arena._height, this.arena._startX, this.arena._startY);
 		this.playerBottom.init(this.arena._width, this.arena._height, this.arena._startX, this.arena._startY);
 	}
-	fetchBall() {
-			this.ball.x = this.denormPosX(this.gameData.ball.x);
-			this.ball.y = this.denormPosY(this.gameData.ball.y);
+	fetchBall(positions) {
+			this.ball.x = this.denormPosX(positions.ball.x);
+			this.ball.y = this.denormPosY(positions.ball.y);
 			this.ball.vx = this.gameData.ball.vx;
 			this.ball.vy = this.gameData.ball.vy;
 			this.ball.speedx = this.denormSpeedX(this.gameData.ball.speedx);
 			this.ball.speedy = this.denormSpeedY(this.gameData.ball.speedy);
 	}
 	fetchAndUpdateFromGameData() {
+		// frames come at the send rate: draw between the last two of them
+		const positions = this.gameData.interpolated();
 
-		this.fetchBall();
+		this.fetchBall(positions);
 
 		this.score.goal = this.gameData.goal;
 
@@ -598,14 +600,14 @@ class Online4P {
 		this.playerTop.direction = this.gameData.top.dir;
 		this.playerBottom.direction = this.gameData.bottom.dir;
 
-		this.playerLeft.x = this.denormPosX(this.gameData.left.x);
-		this.playerLeft.y = this.denormPosY(this.gameData.left.y);
-		this.playerTop.x = this.denormPosX(this.gameData.top.x);
-		this.playerTop.y = this.denormPosY(this.gameData.top.y);
-		this.playerBottom.x = this.denormPosX(this.gameData.bottom.x);
-		this.playerBottom.y = this.denormPosY(this.gameData.bottom.y);
-		this.playerRight.x = this.denormPosX(this.gameData.right.x);
-		this.playerRight.y = this.denormPosY(this.gameData.right.y);
+		this.playerLeft.x = this.denormPosX(positions.left.x);
+		this.playerLeft.y = this.denormPosY(positions.left.y);
+		this.playerTop.x = this.denormPosX(positions.top.x);
+		this.playerTop.y = this.denormPosY(positions.top.y);
+		this.playerBottom.x = this.denormPosX(positions.bottom.x);
+		this.playerBottom.y = this.denormPosY(positions.bottom.y);
+		this.playerRight.x = this.denormPosX(positions.right.x);
+		this.playerRight.y = this.denormPosY(positions.right.y);
 	}
 	update() {
 		this.checkGoal(this.arena._width, this.arena._height, this.arena._startX, this.arena._startY);